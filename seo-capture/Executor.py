@@ -1,19 +1,90 @@
 import json
 import time
 import typing
+import signal
+import sys
+import os
 import Util
 import Session
+import QueueStore
+import Telescope
 import time
 import yaml
 
+
+def json_to_session(msg: dict, quiet: bool = False) -> Session.Session:
+    """ Converts the dictionary representation of a queue request
+    into a Session object, which logs nothing if quiet. """
+    s = Session.Session(targets = msg['targets'],
+                        exposure_time = msg['exposure_time'], 
+                        exposure_count = msg['exposure_count'], 
+                        filters = msg['filters'], 
+                        binning = msg['binning'],
+                        user = msg['user'],
+                        adaptive = msg.get('adaptive', False),
+                        target_snr = msg.get('target_snr', 100.0),
+                        min_exposure_time = msg.get('min_exposure_time', 1.0),
+                        max_exposure_time = msg.get('max_exposure_time', 600.0),
+                        quiet = quiet)
+    return s
+
+
+def read_queue(filename: str, quiet: bool = False) -> typing.List[Session.Session]:
+    """ Reads a JSON queue file, one request per line, and returns the 
+    list of Session objects it describes, in queue order. 
+    """
+    sessions = []
+    with open(filename) as queue:
+        for line in queue:
+            sessions.append(json_to_session(json.loads(line), quiet))
+
+    return sessions
+
+
+def calibration_frames(sessions: typing.List[Session.Session]) -> list:
+    """ Returns the darks and biases needed by every session in sessions,
+    deduplicated so that each dark frame number is taken once per 
+    (exposure_time, binning) and each bias frame number once per binning. 
+    Frames are named as the first session needing them would name them,
+    and each frame's dictionary gains the 'key' it was deduplicated on.
+    """
+    frames = []
+    seen = set()
+    for session in sessions:
+        for frame in session.calibration_frames():
+            if frame["type"] == "dark":
+                key = ("dark", frame["exposure_time"], frame["binning"], frame["number"])
+            else:
+                key = ("bias", frame["binning"], frame["number"])
+            if key not in seen:
+                seen.add(key)
+                frame["key"] = key
+                frames.append(frame)
+
+    return frames
+
+
 class Executor(object):
     """ This class is responsible for executing and scheduling a 
     list of Sessions stored in the JSON queue constructed by the Server. 
     """
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, defer_calibration: bool = False,
+                 calibrate_at: str = "dawn", autofocus: bool = False,
+                 focus_interval: float = 3600, focus_temperature: float = 1.0):
         """ This creates a new executor to execute a single nights
         list of Sessions stored in the JSON file specified by filename. 
+
+        If defer_calibration is True, sessions take only science frames and
+        the darks and biases for the whole queue are taken in one batch with
+        the dome closed, either at "dusk" before the queue or "dawn" after it.
+        A dusk batch is postponed to dawn if the dark window has started, and
+        stops early rather than run into it.
+
+        If autofocus is True, the telescope is focused on the first target of
+        a session whenever focus_interval seconds have passed, or the 
+        temperature has changed by focus_temperature degrees C, since the last
+        focus (and before the first session).
         """
 
         if os.path.isfile("config.yaml"):
@@ -22,25 +93,43 @@ class Executor(object):
         else:
             exit("\033[1;31mExecutor unable to find config.yaml.  Exiting.\033[0m")
 
+        # the observatory location, for the dark window
+        planner = config.get("planner", {})
+        self.latitude = planner.get("latitude", 38.29)
+        self.longitude = planner.get("longitude", -122.50)
+        self.twilight_altitude = planner.get("twilight_altitude", -12.0)
+
         if(filename):
             self.filename=filename
         else:
-            # filename to be read.  This is based on the date
-            qdir = config["server"]["queue_dir"]
-            currdate = time.strftime("%Y-%m-%d", time.gmtime())
-            queuename = "testqname" #set so specified queue can work, but we
-            #are allowed to choose in Server.py so we should be able
-            #to do this here, that is, somehow sync them
-            self.filename = qdir+"/"+queuename+currdate+"_imaging_queue.json"
-        
-
-
-        
+            # tonight's partition of the queue written by the Server
+            store = QueueStore.QueueStore(config["server"]["queue_dir"],
+                                          config["server"].get("queuename", ""),
+                                          latitude = self.latitude,
+                                          longitude = self.longitude,
+                                          twilight_altitude = self.twilight_altitude)
+            self.filename = store.path(store.current_night())
 
         # load queue from disk
         self.sessions = []
         self.load_queue(self.filename)
 
+        # whether darks and biases are batched outside the observing window
+        if calibrate_at not in ("dawn", "dusk"):
+            exit("\033[1;31mExecutor can only calibrate at dawn or dusk. Exiting.\033[0m")
+        self.defer_calibration = defer_calibration
+        self.calibrate_at = calibrate_at
+        self.calibrated = set()
+        for session in self.sessions:
+            session.defer_calibration = defer_calibration
+
+        # when to refocus, and the time and temperature of the last focus
+        self.autofocus = autofocus
+        self.focus_interval = focus_interval
+        self.focus_temperature = focus_temperature
+        self.last_focus_time = None
+        self.last_focus_temp = None
+
         # create a handler for SIGINT
         signal.signal(signal.SIGINT, self.handle_exit)
 
@@ -50,32 +139,131 @@ class Executor(object):
         objects that can then be executed. 
         """
 
-        def json_to_session(msg) -> Session:
-            """ Converts the dictionary representation of a queue request
-            into a Session object. """
-            s = Session.Session(targets = msg['targets'],
-                        exposure_time = msg['exposure_time'], 
-                        exposure_count = msg['exposure_count'], 
-                        filters = msg['filters'], 
-                        binning = msg['binning'],
-                        user = msg['user'])
-            return s
-                    
-        with open(self.filename) as queue:
-            for line in queue:
-                self.sessions.append(json_to_session(json.loads(line)))
+        self.sessions.extend(read_queue(filename))
+        return self.sessions
 
     def execute_queue(self) -> bool:
         """ Executes the list of session objects for this queue. 
         """
+        if self.defer_calibration and self.calibrate_at == "dusk":
+            window = self.dark_window()
+            if window is not None and time.time() >= window[0]:
+                self.__log("The dark window has started; postponing calibration "
+                           "until the queue is finished", color="magenta")
+            elif not self.execute_calibration(until=window[0] if window else None):
+                return False
+
         count = 1
         for session in self.sessions:
             # check whether every session executed correctly
             self.__log("Executing session: {}".format(count), color="cyan")
+            if self.autofocus:
+                self.focus_if_due(session)
             if not session.execute():
                 return False
             count += 1
 
+        # at dusk only the requested exposure times are known, so adaptive
+        # sessions may still need darks at the times they chose
+        if self.defer_calibration:
+            window = self.dark_window()
+            if window is not None and time.time() < window[1]:
+                self.__log("Queue finished {:.0f}s before morning twilight; calibration "
+                           "is using dark time".format(window[1] - time.time()),
+                           color="magenta")
+            return self.execute_calibration()
+
+        return True
+
+
+    def dark_window(self, t: float = None) -> typing.Tuple[float, float]:
+        """ Returns the (start, end) UNIX times of the dark window of the night
+        in progress at t, default now, or None if there is no dark window.
+        """
+        if t is None:
+            t = time.time()
+        return Util.twilight(Util.night_date(t, self.longitude), self.latitude,
+                             self.longitude, self.twilight_altitude)
+
+
+    def focus_if_due(self, session: Session.Session) -> bool:
+        """ Focuses the telescope on the first target of session if the focus
+        policy says it is due. Returns True if the telescope was focused.
+        """
+        telescope = session.telescope
+        temperature = telescope.temperature()
+        if self.last_focus_time is not None:
+            elapsed = time.time() - self.last_focus_time
+            drift = 0.0
+            if temperature is not None and self.last_focus_temp is not None:
+                drift = abs(temperature - self.last_focus_temp)
+            if elapsed < self.focus_interval and drift < self.focus_temperature:
+                return False
+
+        # focus on stars in the session's field
+        if (telescope.open_dome() is False or
+            telescope.goto_target(session.targets[0]) is False):
+            self.__log("Unable to point at a field to focus on", color="red")
+            return False
+
+        self.__log("Focusing telescope...", color="cyan")
+        focused = telescope.focus()
+
+        # don't retry until the policy triggers again, even if it failed
+        self.last_focus_time = time.time()
+        self.last_focus_temp = temperature
+        return focused
+
+
+    def calibration_frames(self) -> list:
+        """ Returns the deduplicated darks and biases needed by every session
+        in the queue; see calibration_frames().
+        """
+        return calibration_frames(self.sessions)
+
+
+    def execute_calibration(self, until: float = None) -> bool:
+        """ Closes the dome and takes the deduplicated darks and biases for
+        the whole queue in one batch, skipping any taken by an earlier batch.
+        If until is given, frames that would not finish before that UNIX time
+        are left for the next batch. Returns False if a frame failed.
+        """
+        frames = [frame for frame in self.calibration_frames()
+                  if frame["key"] not in self.calibrated]
+        if not frames:
+            return True
+        self.__log("Taking {} calibration frames with the dome closed".format(
+            len(frames)), color="cyan")
+
+        # never take calibration frames with the slit open
+        dome = Telescope.Telescope()
+        if dome.dome_status() is True:
+            dome.close_dome()
+
+        # one telescope per (exposure_time, binning) to issue the commands
+        telescopes = {}
+        for count, frame in enumerate(frames):
+            length = frame["exposure_time"] if frame["type"] == "dark" else 0.0
+            if until is not None and time.time() + length > until:
+                self.__log("Stopping calibration at evening twilight; {} frames "
+                           "left for later".format(len(frames) - count),
+                           color="magenta")
+                return True
+
+            key = (frame["exposure_time"], frame["binning"])
+            if key not in telescopes:
+                telescopes[key] = Telescope.Telescope(exposure_time=key[0],
+                                                      binning=key[1])
+            telescope = telescopes[key]
+
+            if frame["type"] == "dark":
+                status = telescope.take_dark(frame["filename"])
+            else:
+                status = telescope.take_bias(frame["filename"])
+            if status is False:
+                return False
+            self.calibrated.add(frame["key"])
+
         return True
 
 
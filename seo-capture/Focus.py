@@ -0,0 +1,33 @@
+# This file implements the V-curve fitting used by the autofocus routine in
+# Telescope.focus()
+import typing
+import numpy as np
+
+
+def fit_vcurve(positions: typing.List[float],
+               fwhms: typing.List[float]) -> typing.Optional[typing.Tuple[float, float]]:
+    """ Fits the hyperbolic V-curve FWHM = a*sqrt(1 + ((x - c)/b)**2) to the
+    FWHM measured at each focuser position, and returns the (c, a) position
+    and FWHM of best focus. Returns None if there are fewer than three
+    points or they do not bracket a minimum.
+
+    Squaring the hyperbola gives a parabola in x, so this is a weighted
+    linear least-squares fit of FWHM**2 rather than an iterative one.
+    """
+    x = np.asarray(positions, dtype=np.float64)
+    y = np.asarray(fwhms, dtype=np.float64)
+    good = np.isfinite(y) & (y > 0)
+    x, y = x[good], y[good]
+    if len(x) < 3:
+        return None
+
+    # weight by 1/y so the relative error on FWHM, not FWHM**2, is fit
+    A, B, C = np.polyfit(x, y**2, 2, w=1/y)
+    if A <= 0:
+        return None
+
+    c = -B/(2*A)
+    a2 = C - B**2/(4*A)
+    if a2 <= 0:
+        return None
+    return float(c), float(np.sqrt(a2))
@@ -0,0 +1,198 @@
+# This file provides fast NumPy routines for measuring the FITS frames taken by
+# the telescope; frames are memory-mapped so only the pixels used are read
+import typing
+import numpy as np
+
+# FITS files are made of 2880 byte blocks of 80 character header cards
+BLOCK = 2880
+CARD = 80
+
+# numpy big-endian types for each FITS BITPIX
+BITPIX = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+
+def read_header(filename: str) -> typing.Tuple[dict, int]:
+    """ Reads the primary header of a FITS file and returns a dictionary of
+    its keywords along with the byte offset at which the data begins.
+    """
+    header = {}
+    offset = 0
+    with open(filename, "rb") as fits:
+        while True:
+            block = fits.read(BLOCK)
+            if len(block) < BLOCK:
+                raise ValueError("{} is not a valid FITS file".format(filename))
+            offset += BLOCK
+            for i in range(0, BLOCK, CARD):
+                card = block[i:i+CARD].decode("ascii", "replace")
+                key = card[0:8].strip()
+                if key == "END":
+                    return header, offset
+                if card[8:10] == "= ":
+                    value = card[10:].split("/")[0].strip()
+                    header[key] = value.strip("'").strip()
+
+
+def read_fits(filename: str) -> np.ndarray:
+    """ Memory-maps the primary image of a FITS file as a 2D array; pixels
+    are only read from disk when they are accessed. BZERO and BSCALE are
+    not applied, so use physical() on any slice that needs them.
+    """
+    header, offset = read_header(filename)
+    if int(header.get("NAXIS", 0)) != 2:
+        raise ValueError("{} does not contain a 2D image".format(filename))
+    shape = (int(header["NAXIS2"]), int(header["NAXIS1"]))
+    data = np.memmap(filename, dtype=BITPIX[int(header["BITPIX"])], mode="r",
+                     offset=offset, shape=shape)
+    data.bzero = float(header.get("BZERO", 0))
+    data.bscale = float(header.get("BSCALE", 1))
+    return data
+
+
+def physical(data: np.ndarray, pixels: np.ndarray) -> np.ndarray:
+    """ Converts a slice of the memory-mapped frame data into physical values
+    as float64, applying the frame's BSCALE and BZERO.
+    """
+    bzero = getattr(data, "bzero", 0.0)
+    bscale = getattr(data, "bscale", 1.0)
+    return np.asarray(pixels, dtype=np.float64)*bscale + bzero
+
+
+def subframe(data: np.ndarray, size: int) -> np.ndarray:
+    """ Returns the central size x size pixels of a frame as float64.
+    """
+    ny, nx = data.shape
+    y0 = max(0, (ny - size)//2)
+    x0 = max(0, (nx - size)//2)
+    return physical(data, data[y0:y0+size, x0:x0+size])
+
+
+def background(pixels: np.ndarray) -> typing.Tuple[float, float]:
+    """ Returns a robust estimate of the (level, noise) of the sky background,
+    from the median and median absolute deviation of the pixels.
+    """
+    level = float(np.median(pixels))
+    noise = 1.4826*float(np.median(np.abs(pixels - level)))
+    return level, noise
+
+
+def find_sources(pixels: np.ndarray, nsigma: float = 5.0, radius: int = 5,
+                 saturation: float = None) -> np.ndarray:
+    """ Returns the (row, column) positions of stars in pixels: local maxima
+    more than nsigma times the noise above the background, at least radius
+    pixels from the edge, and below saturation if given.
+    """
+    level, noise = background(pixels)
+    core = pixels[1:-1, 1:-1]
+    peaks = core > level + nsigma*max(noise, 1e-12)
+    if saturation is not None:
+        peaks &= core < saturation
+
+    # a peak must be strictly brighter than its eight neighbours
+    ny, nx = pixels.shape
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                peaks &= core > pixels[1+dy:ny-1+dy, 1+dx:nx-1+dx]
+
+    rows, cols = np.nonzero(peaks)
+    rows, cols = rows + 1, cols + 1
+    inside = ((rows >= radius) & (rows < ny - radius) &
+              (cols >= radius) & (cols < nx - radius))
+    return np.stack([rows[inside], cols[inside]], axis=1)
+
+
+def fwhm(pixels: np.ndarray, sources: np.ndarray, radius: int = 5,
+         brightest: int = 25) -> float:
+    """ Returns the median FWHM in pixels of the brightest sources, from the
+    second moments of the background-subtracted light in a box of +/-radius
+    pixels around each one. Returns NaN if there are no sources.
+    """
+    if len(sources) == 0:
+        return float("nan")
+
+    level, noise = background(pixels)
+
+    # cut out a box around every source at once
+    offsets = np.arange(-radius, radius+1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+    rows = sources[:, 0][:, None, None] + dy
+    cols = sources[:, 1][:, None, None] + dx
+    boxes = pixels[rows, cols] - level
+
+    # keep the brightest sources, and only light well above the noise
+    order = np.argsort(boxes[:, radius, radius])[::-1][:brightest]
+    boxes = boxes[order]
+    boxes = np.where(boxes > 2*noise, boxes, 0.0)
+
+    flux = boxes.sum(axis=(1, 2))
+    good = flux > 0
+    if not np.any(good):
+        return float("nan")
+    boxes, flux = boxes[good], flux[good]
+
+    # centroid and radial second moment of each source
+    cy = (boxes*dy).sum(axis=(1, 2))/flux
+    cx = (boxes*dx).sum(axis=(1, 2))/flux
+    r2 = ((dy - cy[:, None, None])**2 + (dx - cx[:, None, None])**2)
+    sigma = np.sqrt((boxes*r2).sum(axis=(1, 2))/(2*flux))
+    return float(2.3548*np.median(sigma))
+
+
+def measure_fwhm(filename: str, size: int = 512, nsigma: float = 5.0,
+                 radius: int = 5) -> float:
+    """ Returns the median star FWHM in pixels in the central size x size
+    sub-frame of a FITS file, or NaN if no stars were found.
+    """
+    pixels = subframe(read_fits(filename), size)
+    return fwhm(pixels, find_sources(pixels, nsigma, radius), radius)
+
+
+def neighbours(mask: np.ndarray) -> np.ndarray:
+    """ Returns the number of each pixel's eight neighbours that are set in
+    mask; pixels off the edge count as unset.
+    """
+    padded = np.pad(mask, 1, mode="constant").astype(np.int8)
+    ny, nx = mask.shape
+    count = np.zeros(mask.shape, dtype=np.int8)
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            if dy != 1 or dx != 1:
+                count += padded[dy:dy+ny, dx:dx+nx]
+    return count
+
+
+def quicklook(filename: str, stride: int = 4, saturation: float = 60000.0,
+              rows: int = 256, nsigma: float = 5.0) -> dict:
+    """ Returns quick-look statistics of a FITS frame: the 'background' level
+    and its 'noise', estimated from every stride'th pixel in each direction,
+    and the 'peak' value of the brightest star and the 'saturated' fraction
+    of pixels in saturated star cores, from every pixel, rows lines at a time.
+
+    Only pixels with at least two neighbours that are also above nsigma times
+    the noise (or saturated) count as stars, so hot pixels and cosmic rays are
+    ignored. Returns the background level as the peak if there are no stars.
+    """
+    data = read_fits(filename)
+    level, noise = background(physical(data, data[::stride, ::stride]))
+    threshold = level + nsigma*max(noise, 1e-12)
+
+    peak = level
+    saturated = 0
+    ny = data.shape[0]
+    for row in range(0, ny, rows):
+        # read a line either side so every pixel has all its neighbours
+        first, last = max(0, row - 1), min(ny, row + rows + 1)
+        block = physical(data, data[first:last])
+        inside = slice(row - first, row - first + min(rows, ny - row))
+
+        bright = block > threshold
+        stars = (bright & (neighbours(bright) >= 2))[inside]
+        if np.any(stars):
+            peak = max(peak, float(block[inside][stars].max()))
+
+        clipped = block >= saturation
+        saturated += int(np.count_nonzero((clipped & (neighbours(clipped) >= 2))[inside]))
+
+    return {"background": level, "noise": noise, "peak": peak,
+            "saturated": saturated/float(data.size)}
@@ -0,0 +1,258 @@
+# This file implements a Planner that estimates how long each Session in a queue
+# will take to execute, and whether the queue fits into tonight's dark window
+import json
+import time
+import typing
+import statistics
+import os
+import datetime
+import Util
+import Session
+import Executor
+from Util import find_value
+
+class Planner(object):
+    """ This class estimates the wall-clock duration of imaging Sessions from the
+    commands that Session.execute() issues, and compares a queue against the
+    dark hours of the night it will be executed on.
+    """
+
+    def __init__(self, latitude: float = 38.29, longitude: float = -122.50,
+                 timing_log: str = "telescope_timings.json",
+                 slew_time: float = 60.0, filter_time: float = 10.0,
+                 readout_time: float = 15.0, bias_time: float = 0.5,
+                 twilight_altitude: float = -12.0):
+        """ Creates a new planner for the observatory at the given latitude and
+        longitude (degrees, east positive).
+
+        The slew, filter and readout times (seconds) are only used until
+        calibrate() finds recorded timings for that kind of command.
+
+        Args:
+            latitude: observatory latitude in degrees
+            longitude: observatory longitude in degrees, east positive
+            timing_log: the JSON file of command timings written by Telescope
+            slew_time: default time to point the telescope at a target
+            filter_time: default time to change filter
+            readout_time: default overhead of each frame beyond its exposure
+            bias_time: the exposure time of a bias frame
+            twilight_altitude: sun altitude in degrees that bounds the dark window
+        """
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timing_log = timing_log
+        self.slew_time = slew_time
+        self.filter_time = filter_time
+        self.readout_time = readout_time
+        self.bias_time = bias_time
+        self.twilight_altitude = twilight_altitude
+
+        # replace the defaults with recorded timings if we have any
+        self.calibrate()
+
+
+    def calibrate(self) -> bool:
+        """ Calibrates the slew, filter-change and readout costs from the
+        median of the command timings recorded by the Telescope. Returns True
+        if any timings were found, False otherwise.
+        """
+        if not self.timing_log or not os.path.isfile(self.timing_log):
+            return False
+
+        slews, filters, readouts = [], [], []
+        with open(self.timing_log) as timings:
+            for line in timings:
+                try:
+                    record = json.loads(line)
+                    command = record["command"]
+                    duration = float(record["duration"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if command.startswith("image"):
+                    exptime = find_value("time", command)
+                    if exptime:
+                        readouts.append(duration - float(exptime))
+                elif command.startswith("pfilter "):
+                    filters.append(duration)
+                elif command.endswith("| dopoint") or command.startswith("tx point"):
+                    # only pointing commands; "catalog X | altaz" is a query
+                    slews.append(duration)
+
+        if slews:
+            self.slew_time = statistics.median(slews)
+        if filters:
+            self.filter_time = statistics.median(filters)
+        if readouts:
+            self.readout_time = max(0.0, statistics.median(readouts))
+
+        self.__log("Calibrated from {} timings: slew={:.1f}s filter={:.1f}s "
+                   "readout={:.1f}s".format(len(slews)+len(filters)+len(readouts),
+                                            self.slew_time, self.filter_time,
+                                            self.readout_time))
+        return bool(slews or filters or readouts)
+
+
+    def estimate_session(self, session: Session.Session) -> float:
+        """ Returns the estimated wall-clock time in seconds to execute session,
+        counting the same exposures, darks and biases that Session.execute()
+        takes for every target. Adaptive sessions may lengthen their exposures
+        up to max_exposure_time, so they are estimated at that upper bound.
+        """
+        exposure_time = session.exposure_time
+        if session.adaptive:
+            exposure_time = max(exposure_time, session.max_exposure_time)
+        frame = exposure_time + self.readout_time
+        nfilters = len(session.filters)
+        count = session.exposure_count
+
+        per_target = self.slew_time
+
+        # science frames for each filter, then reset to clear
+        per_target += nfilters*(self.filter_time + count*frame)
+        per_target += self.filter_time
+
+        duration = len(session.targets)*per_target
+
+        # darks and biases, unless the Executor takes them outside the night
+        if not session.defer_calibration:
+            duration += self.estimate_calibration(session.calibration_frames(),
+                                                  exposure_time)
+
+        return duration
+
+
+    def estimate_calibration(self, frames: typing.List[dict],
+                             exposure_time: float = None) -> float:
+        """ Returns the estimated wall-clock time in seconds to take a list of
+        calibration frames, as returned by Session.calibration_frames(). If
+        exposure_time is given, darks are estimated at that time instead.
+        """
+        duration = 0.0
+        for frame in frames:
+            if frame["type"] == "dark":
+                if exposure_time is None:
+                    duration += frame["exposure_time"] + self.readout_time
+                else:
+                    duration += exposure_time + self.readout_time
+            else:
+                duration += self.bias_time + self.readout_time
+        return duration
+
+
+    def dark_window(self, t: float = None) -> typing.Tuple[float, float]:
+        """ Returns the (start, end) UNIX times of the dark window of the night
+        containing t (default now), or of the following night if that window
+        has already ended. Returns None if there is no dark window.
+        """
+        if t is None:
+            t = time.time()
+        night = Util.night_date(t, self.longitude)
+        window = Util.twilight(night, self.latitude, self.longitude,
+                               self.twilight_altitude)
+        if window is not None and t > window[1]:
+            window = Util.twilight(night + datetime.timedelta(days=1),
+                                   self.latitude, self.longitude,
+                                   self.twilight_altitude)
+        return window
+
+
+    def plan(self, sessions: typing.List[Session.Session],
+             t: float = None) -> typing.List[dict]:
+        """ Lays sessions out back-to-back from the start of tonight's dark
+        window (or t, default now, if that is later) and returns a list with a
+        dictionary for each session containing its estimated 'duration',
+        'start' and 'end' times, whether it 'fits' in the dark window, and by
+        how many seconds it 'overrun's the end of the window.
+        """
+        if t is None:
+            t = time.time()
+        window = self.dark_window(t)
+        if window is None:
+            window = (t, t)
+
+        start = max(t, window[0])
+        plan = []
+        for session in sessions:
+            duration = self.estimate_session(session)
+            end = start + duration
+            plan.append({"session": session, "duration": duration,
+                         "start": start, "end": end, "fits": end <= window[1],
+                         "overrun": max(0.0, end - window[1])})
+            start = end
+
+        return plan
+
+
+    def plan_calibration(self, sessions: typing.List[Session.Session],
+                         t: float = None) -> dict:
+        """ Estimates the batch of darks and biases that the Executor takes for
+        sessions when calibration is deferred, and returns a dictionary with
+        the number of 'frames', their 'duration', and the seconds between
+        sunset and the start of the dark window ('dusk') and between its end
+        and sunrise ('dawn') in which the batch can run without using dark time.
+        """
+        frames = Executor.calibration_frames(sessions)
+        duration = self.estimate_calibration(frames)
+
+        window = self.dark_window(t)
+        if window is None:
+            return {"frames": len(frames), "duration": duration,
+                    "dusk": 0.0, "dawn": 0.0}
+        night = Util.night_date(window[0], self.longitude)
+        sun = Util.twilight(night, self.latitude, self.longitude, -0.833)
+        if sun is None:
+            sun = window
+        return {"frames": len(frames), "duration": duration,
+                "dusk": max(0.0, window[0] - sun[0]),
+                "dawn": max(0.0, sun[1] - window[1])}
+
+
+    def plan_queue(self, filename: str, t: float = None,
+                   defer_calibration: bool = False) -> typing.List[dict]:
+        """ Reads the queue file filename, as the Executor would, and returns
+        its plan(). The sessions are built quietly since they are never run.
+        """
+        sessions = Executor.read_queue(filename, quiet=True)
+        for session in sessions:
+            session.defer_calibration = defer_calibration
+        return self.plan(sessions, t)
+
+
+    def report(self, plan: typing.List[dict]) -> bool:
+        """ Logs a plan to STDOUT, flagging sessions that will not fit in the
+        dark window. Returns True if every session fits, False otherwise.
+        """
+        for count, entry in enumerate(plan, 1):
+            start = time.strftime("%H:%M:%S", time.gmtime(entry["start"]))
+            end = time.strftime("%H:%M:%S", time.gmtime(entry["end"]))
+            msg = "Session {} ({}): {:.0f}s from {} to {} UTC".format(
+                count, entry["session"].user, entry["duration"], start, end)
+            if entry["fits"]:
+                self.__log(msg, color="green")
+            else:
+                self.__log(msg+" does not fit before twilight", color="red")
+
+        return all(entry["fits"] for entry in plan)
+
+
+    def report_calibration(self, calibration: dict) -> bool:
+        """ Logs a plan_calibration() estimate to STDOUT, flagging a batch that
+        would use dark time. Returns True if it fits at dusk or dawn.
+        """
+        msg = "Calibration: {} frames in {:.0f}s; {:.0f}s free at dusk, {:.0f}s at dawn".format(
+            calibration["frames"], calibration["duration"],
+            calibration["dusk"], calibration["dawn"])
+        fits = calibration["duration"] <= max(calibration["dusk"], calibration["dawn"])
+        if fits:
+            self.__log(msg, color="green")
+        else:
+            self.__log(msg+"; the batch will use dark time", color="red")
+
+        return fits
+
+
+    def __log(self, msg: str, color: str = "white") -> bool:
+        """ Prints a log message to STDOUT. Returns True if successful, False
+        otherwise.
+        """
+        return Util.log(msg, color)
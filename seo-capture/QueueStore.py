@@ -0,0 +1,294 @@
+# This file implements the on-disk storage for imaging queues; the queue is
+# partitioned by observing night, and closed nights are compressed into an archive
+import datetime
+import gzip
+import json
+import os
+import shutil
+import time
+import typing
+import Util
+
+class QueueStore(object):
+    """ This class stores imaging requests in one JSON file per observing night,
+    named queuename+YYYY-MM-DD+"_imaging_queue.json" where the date is that of
+    the evening the night starts on. Requests are written to the next night
+    whose dark window has not yet started; once a night is over its partition
+    is gzipped into queue_dir/archive and recorded in a per-night index.
+    """
+
+    def __init__(self, queue_dir: str, queuename: str = "",
+                 latitude: float = 38.29, longitude: float = -122.50,
+                 twilight_altitude: float = -12.0,
+                 keep_nights: int = 1, keep_archives: int = 0):
+        """ Creates a queue store in queue_dir.
+
+        Args:
+            queue_dir: the directory holding the live queue partitions
+            queuename: string to be prepended to every partition file name
+            latitude: observatory latitude in degrees
+            longitude: observatory longitude in degrees, east positive
+            twilight_altitude: sun altitude in degrees at which nights rotate
+            keep_nights: how many closed nights to leave uncompressed
+            keep_archives: how many nights of archives to keep; 0 keeps all
+        """
+        self.queue_dir = queue_dir
+        self.queuename = queuename
+        self.latitude = latitude
+        self.longitude = longitude
+        self.twilight_altitude = twilight_altitude
+        self.keep_nights = keep_nights
+        self.keep_archives = keep_archives
+
+        self.archive_dir = os.path.join(queue_dir, "archive")
+        self.index_file = os.path.join(self.archive_dir, "index.json")
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+
+    def filename(self, night: datetime.date) -> str:
+        """ Returns the base file name of the partition for night.
+        """
+        return self.queuename+night.strftime("%Y-%m-%d")+"_imaging_queue.json"
+
+
+    def path(self, night: datetime.date) -> str:
+        """ Returns the path of the live partition for night.
+        """
+        return os.path.join(self.queue_dir, self.filename(night))
+
+
+    def window(self, night: datetime.date) -> typing.Tuple[float, float]:
+        """ Returns the (start, end) UNIX times of the dark window of night, or
+        None if the sun never sets far enough.
+        """
+        return Util.twilight(night, self.latitude, self.longitude,
+                             self.twilight_altitude)
+
+
+    def current_night(self, t: float = None) -> datetime.date:
+        """ Returns the observing night in progress (or about to start) at t,
+        default now; this is the night the Executor should be running.
+        """
+        if t is None:
+            t = time.time()
+        return Util.night_date(t, self.longitude)
+
+
+    def ingest_night(self, t: float = None) -> datetime.date:
+        """ Returns the night that requests received at t, default now, are
+        queued for; this rolls over to the next night at evening twilight.
+        """
+        if t is None:
+            t = time.time()
+        night = self.current_night(t)
+        window = self.window(night)
+        if window is not None and t >= window[0]:
+            night += datetime.timedelta(days=1)
+        return night
+
+
+    def append(self, night: datetime.date, msg: dict) -> bool:
+        """ Appends a request to the partition for night. Returns True if
+        successful, False otherwise.
+        """
+        try:
+            with open(self.path(night), "a") as queue:
+                queue.write(json.dumps(msg)+"\n")
+                queue.flush()
+                os.fsync(queue.fileno())
+            return True
+        except OSError as e:
+            self.__log("Unable to write to queue: {}".format(e), color="red")
+            return False
+
+
+    def count(self, night: datetime.date) -> int:
+        """ Returns the number of requests in the live partition for night.
+        """
+        if not os.path.isfile(self.path(night)):
+            return 0
+        with open(self.path(night)) as queue:
+            return sum(1 for line in queue if line.strip())
+
+
+    def rotate(self, t: float = None) -> datetime.date:
+        """ Creates the partition that requests received at t are queued for,
+        archives every live partition for a night that has finished, and
+        applies the retention policy. Returns the night requests go to.
+        """
+        if t is None:
+            t = time.time()
+        night = self.ingest_night(t)
+        open(self.path(night), "a").close()
+        self.recover()
+
+        # nights whose dark window ended more than keep_nights nights ago
+        oldest = self.current_night(t) - datetime.timedelta(days=self.keep_nights)
+        for live in self.live_nights():
+            window = self.window(live)
+            finished = window is None or window[1] < t
+            if live < oldest and finished:
+                self.archive(live)
+
+        if self.keep_archives > 0:
+            self.expire(self.current_night(t) -
+                        datetime.timedelta(days=self.keep_archives))
+
+        return night
+
+
+    def live_nights(self, extension: str = "") -> typing.List[datetime.date]:
+        """ Returns the sorted nights that have an uncompressed partition, or
+        a partition file with the given extension appended.
+        """
+        suffix = "_imaging_queue.json"+extension
+        nights = []
+        for name in os.listdir(self.queue_dir):
+            if not (name.startswith(self.queuename) and name.endswith(suffix)):
+                continue
+            date = name[len(self.queuename):-len(suffix)]
+            try:
+                nights.append(datetime.datetime.strptime(date, "%Y-%m-%d").date())
+            except ValueError:
+                continue
+        return sorted(nights)
+
+
+    def archive(self, night: datetime.date) -> bool:
+        """ Compresses the partition for night into the archive, records it in
+        the index and removes the live file. Returns True if successful.
+
+        The partition is first renamed to a '.archiving' marker, and the
+        index records the archive as it was before ('pending') until the
+        marker is gone, so archiving a night interrupted at any point is
+        finished by the next call without duplicating any requests.
+        """
+        self.finish_archive(night)
+        source = self.path(night)
+        if not os.path.isfile(source):
+            return False
+
+        os.replace(source, source+".archiving")
+        self.finish_archive(night)
+        self.__log("Archived queue for the night of {}".format(night))
+        return True
+
+
+    def finish_archive(self, night: datetime.date) -> bool:
+        """ Completes archiving the '.archiving' marker of night, or the index
+        entry left pending by an interrupted archive(). Returns True if there
+        was anything to finish.
+        """
+        marker = self.path(night)+".archiving"
+        dest = os.path.join(self.archive_dir, self.filename(night)+".gz")
+        index = self.read_index()
+        entry = index.get(night.isoformat(), {"file": os.path.basename(dest),
+                                              "requests": 0, "bytes": 0})
+
+        # record the last complete state of the archive before changing it
+        if "pending" not in entry:
+            if not os.path.isfile(marker):
+                return False
+            with open(marker) as queue:
+                adding = sum(1 for line in queue if line.strip())
+            entry["pending"] = {"bytes": entry.get("bytes", 0),
+                                "requests": entry["requests"], "adding": adding}
+            index[night.isoformat()] = entry
+            self.write_index(index)
+        pending = entry["pending"]
+
+        if os.path.isfile(marker):
+            # rebuild from the last complete state in a temporary file, which
+            # drops any gzip member appended by an interrupted archive
+            with open(dest+".tmp", "wb") as tmp:
+                if pending["bytes"] > 0:
+                    with open(dest, "rb") as archive:
+                        tmp.write(archive.read(pending["bytes"]))
+            with open(marker, "rb") as queue, gzip.open(dest+".tmp", "ab") as archive:
+                shutil.copyfileobj(queue, archive)
+            os.replace(dest+".tmp", dest)
+            os.remove(marker)
+
+        entry["bytes"] = os.path.getsize(dest)
+        entry["requests"] = pending["requests"] + pending["adding"]
+        del entry["pending"]
+        self.write_index(index)
+        return True
+
+
+    def recover(self) -> int:
+        """ Finishes every archive() that was interrupted. Returns the number
+        of nights recovered.
+        """
+        nights = set(self.live_nights(".archiving"))
+        for night, entry in self.read_index().items():
+            if "pending" in entry:
+                nights.add(datetime.datetime.strptime(night, "%Y-%m-%d").date())
+        return sum(1 for night in sorted(nights) if self.finish_archive(night))
+
+
+    def expire(self, before: datetime.date) -> int:
+        """ Deletes archived nights earlier than before. Returns the number of
+        nights deleted.
+        """
+        index = self.read_index()
+        expired = [n for n in index if n < before.isoformat()]
+        for night in expired:
+            try:
+                os.remove(os.path.join(self.archive_dir, index[night]["file"]))
+            except FileNotFoundError:
+                pass
+            del index[night]
+        if expired:
+            self.write_index(index)
+            self.__log("Deleted {} archived nights".format(len(expired)))
+        return len(expired)
+
+
+    def read_index(self) -> dict:
+        """ Returns the archive index, mapping ISO dates to archive entries.
+        """
+        if not os.path.isfile(self.index_file):
+            return {}
+        with open(self.index_file) as index:
+            return json.load(index)
+
+
+    def write_index(self, index: dict) -> bool:
+        """ Atomically replaces the archive index.
+        """
+        with open(self.index_file+".tmp", "w") as tmp:
+            json.dump(index, tmp, sort_keys=True, indent=1)
+        os.replace(self.index_file+".tmp", self.index_file)
+        return True
+
+
+    def requests(self, first: datetime.date,
+                 last: datetime.date) -> typing.Iterator[typing.Tuple[datetime.date, dict]]:
+        """ Yields (night, request) for every request queued for a night from
+        first to last inclusive. Only the partitions in range are opened.
+        """
+        index = self.read_index()
+        night = first
+        while night <= last:
+            if os.path.isfile(self.path(night)):
+                stream = open(self.path(night))
+            elif night.isoformat() in index:
+                stream = gzip.open(os.path.join(self.archive_dir,
+                                                index[night.isoformat()]["file"]), "rt")
+            else:
+                stream = None
+
+            if stream is not None:
+                with stream:
+                    for line in stream:
+                        if line.strip():
+                            yield night, json.loads(line)
+            night += datetime.timedelta(days=1)
+
+
+    def __log(self, msg: str, color: str = "white") -> bool:
+        """ Prints a log message to STDOUT. Returns True if successful, False
+        otherwise.
+        """
+        return Util.log(msg, color)
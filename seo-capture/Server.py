@@ -8,7 +8,59 @@ import sys
 import json
 import yaml
 import os
-import requests
+import Planner
+import QueueStore
+import Util
+
+def normalise_request(msg: dict) -> dict:
+    """ Validates an imaging request and returns a copy with every field
+    converted to the type the Executor expects; filters given as a string
+    are split on commas. Raises ValueError describing the first bad field.
+    """
+    def number(key: str, kind: type, default=None):
+        value = msg.get(key, default)
+        if value is None:
+            raise ValueError("missing "+key)
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError("invalid "+key)
+        try:
+            value = kind(float(value))
+        except (ValueError, OverflowError):
+            raise ValueError("invalid "+key)
+        if not value > 0 or value == float("inf"):
+            raise ValueError(key+" must be positive")
+        return value
+
+    targets = msg.get("targets")
+    if (not isinstance(targets, list) or len(targets) == 0 or
+        not all(isinstance(t, str) and t.strip() for t in targets)):
+        raise ValueError("targets must be a non-empty list of names")
+
+    filters = msg.get("filters", ["clear"])
+    if isinstance(filters, str):
+        filters = [f.strip() for f in filters.split(",") if f.strip()]
+    if (not isinstance(filters, list) or len(filters) == 0 or
+        not all(isinstance(f, str) and f.strip() for f in filters)):
+        raise ValueError("filters must be a non-empty list of names")
+
+    adaptive = msg.get("adaptive", False)
+    if adaptive not in (True, False):
+        raise ValueError("adaptive must be true or false")
+
+    request = {"magic": msg["magic"], "user": str(msg["user"]),
+               "targets": [t.strip() for t in targets],
+               "exposure_time": number("exposure_time", float),
+               "exposure_count": number("exposure_count", int, 1),
+               "filters": [f.strip() for f in filters],
+               "binning": number("binning", int, 2),
+               "adaptive": bool(adaptive),
+               "target_snr": number("target_snr", float, 100.0),
+               "min_exposure_time": number("min_exposure_time", float, 1.0),
+               "max_exposure_time": number("max_exposure_time", float, 600.0)}
+    if request["min_exposure_time"] > request["max_exposure_time"]:
+        raise ValueError("min_exposure_time exceeds max_exposure_time")
+    return request
+
 
 class Server(object):
     """ This class represents a server that listens for queueing requests from 
@@ -53,27 +105,59 @@ class Server(object):
         # zeroMQ context
         self.context = zmq.Context()
 
+        # ingest limits; anything not specified in config.yaml uses the default
+        limits = {"high_water_mark": 100, "max_message_bytes": 16384,
+                  "max_targets": 20, "max_exposures": 500,
+                  "max_queue_requests": 200, "rate": 1/60, "burst": 10,
+                  "global_rate": 1, "global_burst": 20,
+                  "max_exposure_time": 600, "max_target_snr": 1000}
+        limits.update(config["server"].get("limits", {}))
+        self.max_targets = limits["max_targets"]
+        self.max_exposures = limits["max_exposures"]
+        self.max_exposure_time = limits["max_exposure_time"]
+        self.max_target_snr = limits["max_target_snr"]
+        self.max_message_bytes = limits["max_message_bytes"]
+        self.max_queue_requests = limits["max_queue_requests"]
+
+        # per-user token buckets refilling at rate requests/s up to burst
+        self.rate = limits["rate"]
+        self.burst = limits["burst"]
+        self.buckets = {}
+
+        # a server-wide bucket so that clients varying their user name
+        # still can't flood the queue
+        self.global_bucket = Util.TokenBucket(limits["global_rate"],
+                                              limits["global_burst"])
+
         # zeroMQ socket
         self.socket = self.context.socket(zmq.REP)
 
+        # bound how many messages queue up in zmq; messages over
+        # max_message_bytes are refused with a reply, but zmq drops any peer
+        # sending something far larger before it is ever read into memory
+        self.socket.setsockopt(zmq.RCVHWM, limits["high_water_mark"])
+        self.socket.setsockopt(zmq.SNDHWM, limits["high_water_mark"])
+        self.socket.setsockopt(zmq.MAXMSGSIZE, 16*limits["max_message_bytes"])
+
         # connect socket
         self.socket.bind("tcp://*:%s" % self.port)
         self.__log("Bound server to socket %s" % self.port)
 
-        # file name for JSON store
-        qdir = config["server"]["queue_dir"]
-        currdate = time.strftime("%Y-%m-%d", time.gmtime())
-        self.filename = qdir+"/"+queuename+currdate+"_imaging_queue.json"
-        self.file = open(self.filename, 'w')
-        if self.file is None:
-            self.__log("Unable to open queue!", color="red")
-        self.__log("Storing queue in %s" % self.filename)
-        self.file.close()
+        # planner used to warn submitters when the queue overruns the night
+        self.planner = Planner.Planner(**config.get("planner", {}))
+
+        # queue storage partitioned by observing night
+        retention = config["server"].get("retention", {})
+        self.store = QueueStore.QueueStore(config["server"]["queue_dir"], queuename,
+                                           latitude = self.planner.latitude,
+                                           longitude = self.planner.longitude,
+                                           twilight_altitude = self.planner.twilight_altitude,
+                                           **retention)
+        self.night = None
+        self.rotate()
 
-        #twilight for the day and time functions
-        time.timezone = 8*3600 #Sonoma, Cali is UTC-8
-        self.twilight = self.getTwilightToday()
-        self.closedqueue = False
+        # rotate on a timer too, so quiet nights are still archived
+        self.rotate_interval = config["server"].get("rotate_interval", 300)
 
         # create a handler for SIGINT
         signal.signal(signal.SIGINT, self.handle_exit)
@@ -86,7 +170,6 @@ class Server(object):
         choice = input().lower()
         if choice == "y" or choice == "Y":
             print("\033[1;31mQuitting server...\033[0m")
-            self.file.close()
             sys.exit(0)
         
     def __del__(self):
@@ -97,138 +180,139 @@ class Server(object):
 
 
 
-    #gets twilight for the given day
-    def getTwilightToday(day):
-        urllist = []
-        urllist.append("aa.usno.navy.mil/rstt/onedaytable?ID=AA?year=")
-        urllist.append(str(day[0]))
-        urllist.append("&month=")
-        urllist.append(str(day[1]))
-        urllist.append("&day=")
-        urllist.append(str(day[2]))
-        urllist.append("&state=CA&place=Sonoma")
-        url = ''.join(urllist)
-        r = requests.get(url)
-        hour = int(r.text[2581:2582])+12
-        minute = int(r.text[2583:2585])    #<--- this fails currently as there is slight variance in length of page
-        #EG http://aa.usno.navy.mil/rstt/onedaytable?ID=AA&year=2016&month=12&day=15&state=CA&place=Sonoma
-        
-
-        return time.struct_time(day[0],day[1],day[2],18,0,0,day[6],day[7],day[8])
-        
-
-    #checks if it is currently later than twilight
-    def laterThanTwilight(self):
-        lt = time.localtime
-        tw = self.twilight
-        #this is ugly, should write a comparison function for struct_time objects
-        if(lt[3]>tw[3] or (lt[3]==tw[3] and (lt[4]>tw[4] or (lt[4]==tw[4] and lt[5]>tw[5])))):
-            return True
-        return False
-
-
-    
+    def rotate(self) -> bool:
+        """ Switches the queue to the next night once tonight's dark window 
+        starts, archiving finished nights. Returns True if the queue rotated.
+        """
+        night = self.store.rotate()
+        if night == self.night:
+            return False
 
-    #given a struct_time object, increments it by one day
-    #this function is super gross...
-    def incrementDay(day):
-        if(day[1]==1):
-            if(day[2]==31):
-                return time.struct_time(day[0],2,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],1,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==2):
-            if(day[2]==29):
-                return time.struct_time(day[0],3,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            elif(day[2]==28):
-                if(day[0]%4==0):
-                    return time.struct_time(day[0],2,29,day[3],day[4],day[5],day[6],day[7],day[8])
-                return time.struct_time(day[0],3,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],2,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==3):
-            if(day[2]==31):
-                return time.struct_time(day[0],4,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],3,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==4):
-            if(day[2]==30):
-                return time.struct_time(day[0],5,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],4,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==5):
-            if(day[2]==31):
-                return time.struct_time(day[0],6,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],5,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==6):
-            if(day[2]==30):
-                return time.struct_time(day[0],7,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],6,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==7):
-            if(day[2]==31):
-                return time.struct_time(day[0],8,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],7,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==8):
-            if(day[2]==31):
-                return time.struct_time(day[0],9,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],8,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==9):
-            if(day[2]==30):
-                return time.struct_time(day[0],10,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],9,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==10):
-            if(day[2]==31):
-                return time.struct_time(day[0],11,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],10,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        elif(day[1]==11):
-            if(day[2]==30):
-                return time.struct_time(day[0],12,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],11,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        else: #assuming this means it is december
-            if(day[2]==31):
-                return time.struct_time(day[0]+1,1,day[3],day[4],day[5],day[6],day[7],day[8])
-            return time.struct_time(day[0],12,day[2]+1,day[3],day[4],day[5],day[6],day[7],day[8])
-        ###END FUNCTION incrementDay()###############
-
-                
-
-    #creates the queue file for the next day
-    def queueNextDay(self):
-        qdir = config["server"]["queue_dir"]
-        currdate = time.strftime("%Y-%m-%d", incrementDay(time.gmtime()))
-        self.filename = qdir+"/"+queuename+currdate+"_imaging_queue.json"
-        self.file = open(self.filename, 'w')
-        if self.file is None:
-            self.__log("Unable to open queue!", color="red")
+        self.night = night
+        self.filename = self.store.path(night)
+        self.queue_length = self.store.count(night)
         self.__log("Storing queue in %s" % self.filename)
-        self.file.close()
-
+        return True
 
 
-        
     def start(self):
         """ Starts the servers listening for new requests; server blocks
         on the specified port until it receives a request
         """
+        last_rotate = time.time()
         while True:
-            laterthantwilight = self.laterThanTwilight()
-            if(laterthantwilight and not self.closedqueue):
-                self.queueNextDay()
-                self.closedqueue = True
-            elif(self.closedqueue and not laterthantwilight):
-                #it is now the next day
-                self.twilight = self.getTwilightToday()
-                self.closedqueue = False
+            # wake up at least every rotate_interval seconds
+            if self.socket.poll(1000*self.rotate_interval):
+                # a REP socket must answer every message before the next
+                self.socket.send_string(self.handle_message(self.socket.recv()))
+
+            if time.time() - last_rotate >= self.rotate_interval:
+                try:
+                    self.rotate()
+                except OSError as e:
+                    self.__log("Unable to rotate queue: {}".format(e), color="red")
+                last_rotate = time.time()
+
+    def handle_message(self, raw: bytes) -> str:
+        """ Processes one raw message from a client and returns the reply
+        to send back to it.
+        """
+        if len(raw) > self.max_message_bytes:
+            return "rejected message exceeds {} bytes".format(self.max_message_bytes)
+
+        try:
+            message = json.loads(json.loads(raw))
+            user = str(message["user"])
+            magic = message["magic"]
+        except (ValueError, TypeError, KeyError):
+            self.__log("Received malformed message from a client...", color="yellow")
+            return "rejected malformed request"
+
+        # refuse clients that are submitting too quickly
+        bucket = self.get_bucket(user)
+        if not bucket.consume():
+            return "retry {:.0f} rate limit exceeded for {}".format(
+                bucket.wait_time(), user)
+
+        # shed load only after the per-user check, so that one client
+        # exceeding its own limit cannot drain the budget for everyone
+        if not self.global_bucket.consume():
+            return "retry {:.0f} server is busy".format(
+                max(1, self.global_bucket.wait_time()))
+
+        if magic == self.magic:
+            self.__log("Received imaging request from {}...".format(user))
+            reply, request = self.admit_request(message)
+            if reply:
+                self.__log("Refused request from {}: {}".format(user, reply),
+                           color="yellow")
+                return reply
+            self.save_request(request)
+            warning = self.check_capacity()
+            if warning:
+                return str(self.magic)+" "+warning
+            return str(self.magic)
+        elif magic == self.magic_admin:
+            self.__log("Received message from {}...".format(user))
+            reply = self.process_message(message)
+            if reply:
+                return reply
+            return str(self.magic_admin)
+        else:
+            self.__log("Received invalid message from a client...")
+            return "rejected invalid magic number"
+
+    def get_bucket(self, user: str) -> Util.TokenBucket:
+        """ Returns the rate-limiting token bucket for user, creating a full
+        one if this user has not been seen (or has been idle long enough for
+        their bucket to be forgotten).
+        """
+        if user not in self.buckets:
+            # forget users whose buckets have refilled so the table stays small
+            if len(self.buckets) >= 1024:
+                self.buckets = {u: b for u, b in self.buckets.items()
+                                if b.refill() < b.capacity}
+            self.buckets[user] = Util.TokenBucket(self.rate, self.burst)
+        return self.buckets[user]
+
+    def admit_request(self, msg: dict) -> typing.Tuple[str, dict]:
+        """ Checks an imaging request against the ingest limits. Returns the
+        reply to refuse it with, or an empty string if it can be queued, along
+        with the normalised request that should be saved.
+        """
+        if not self.enabled:
+            return "retry 600 server is not accepting requests", None
+        self.rotate()
+        if self.queue_length >= self.max_queue_requests:
+            return "retry 3600 queue is full for tonight", None
+
+        try:
+            request = normalise_request(msg)
+        except ValueError as e:
+            return "rejected "+str(e), None
+
+        targets = len(request["targets"])
+        exposures = targets*len(request["filters"])*request["exposure_count"]
+        if targets > self.max_targets:
+            return "rejected {} targets exceeds the limit of {}".format(
+                targets, self.max_targets), None
+        if exposures > self.max_exposures:
+            return "rejected {} exposures exceeds the limit of {}".format(
+                exposures, self.max_exposures), None
+
+        # adaptive sessions may run up to max_exposure_time, so cap it too
+        longest = request["exposure_time"]
+        if request["adaptive"]:
+            longest = max(longest, request["max_exposure_time"])
+        if longest > self.max_exposure_time:
+            return "rejected {}s exposures exceed the limit of {}s".format(
+                longest, self.max_exposure_time), None
+        if request["target_snr"] > self.max_target_snr:
+            return "rejected SNR {} exceeds the limit of {}".format(
+                request["target_snr"], self.max_target_snr), None
+
+        return "", request
 
-            
-            message = json.loads(self.socket.recv_json())
-            if message["magic"] == self.magic:
-                self.__log("Received imaging request from {}...".format(message["user"]))
-                self.save_request(message)
-                self.socket.send_string(str(self.magic))
-            elif message["magic"] == self.magic_admin:
-                self.__log("Received message from {}...".format(message["user"]))
-                self.process_message(message)
-                self.socket.send_string(str(self.magic_admin))
-            else:
-                self.__log("Received invalid message from a client...")
-            
     def __log(self, msg: str, color: str = "white") -> bool:
         """ Prints a log message to STDOUT. Returns True if successful, False
         otherwise.
@@ -257,21 +341,50 @@ class Server(object):
         """ This takes a raw message from zmq and writes the JSON data
         into the queue file. 
         """
-        self.file = open(self.filename, "a")
-        self.file.write(json.dumps(msg)+"\n")
-        self.file.close()
+        if self.store.append(self.night, msg):
+            self.queue_length += 1
 
-    def process_message(self, msg: str) -> list:
-        """ This processes an admin message to alter the server state.
+    def check_capacity(self) -> str:
+        """ Plans the queue file and returns a warning for the submitter if
+        the most recent request will not fit in tonight's dark window, or an
+        empty string otherwise.
+        """
+        try:
+            # plan from the start of the night being queued for, not tonight's
+            t = time.time()
+            window = self.store.window(self.night)
+            if window is not None:
+                t = max(t, window[0])
+            plan = self.planner.plan_queue(self.filename, t)
+        except Exception as e:
+            # the warning is advisory, so never let it take down ingest
+            self.__log("Unable to plan queue: {}".format(e), color="yellow")
+            return ""
+
+        if not plan or plan[-1]["fits"]:
+            return ""
+
+        overrun = plan[-1]["overrun"]
+        self.__log("Queue overruns the dark window by {:.0f}s".format(overrun),
+                   color="yellow")
+        return ("Warning: queue is full for tonight; this request is estimated "
+                "to finish {:.0f} minutes after twilight".format(overrun/60))
+
+    def process_message(self, msg: dict) -> str:
+        """ This processes an admin message to alter the server state. Returns
+        the reply to refuse it with, or an empty string if it was applied.
         """
-        if msg['type'] == 'state':
-            if msg['action'] == 'enable':
+        if msg.get('type') == 'state':
+            if msg.get('action') == 'enable':
                 self.__log("Enabling queueing server...", color="cyan")
                 self.enabled = True
-            elif msg['action'] == 'disable':
+            elif msg.get('action') == 'disable':
                 self.__log("Disabling queueing server...", color="cyan")
                 self.enabled = False
             else:
                 self.__log("Received invalid admin state message...", color="magenta")
+                return "rejected unknown state action"
         else:
-            self.__log("Received unknown admin message...", color+"magenta")
+            self.__log("Received unknown admin message...", color="magenta")
+            return "rejected unknown admin message type"
+        return ""
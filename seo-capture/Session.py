@@ -1,6 +1,7 @@
 from typing import List, Union
 from Util import find_value
 import Telescope
+import Image
 import subprocess
 import Util
 import time
@@ -23,7 +24,14 @@ class Session(object):
                  user: str = "",
                  nodark: bool = False, 
                  nobias: bool = False,
-                 offsets: str = ""):
+                 offsets: str = "",
+                 defer_calibration: bool = False,
+                 adaptive: bool = False,
+                 target_snr: float = 100.0,
+                 min_exposure_time: float = 1.0,
+                 max_exposure_time: float = 600.0,
+                 saturation: float = 60000.0,
+                 quiet: bool = False):
         """ Creates a new imaging session with desired parameters.
 
         Creates a new imaging session that will image each target with exposure_count 
@@ -34,11 +42,24 @@ class Session(object):
                     ['m31, 'C 34', 'NGC 6974']
             exposure_time: the time for each exposure in seconds
             exposure_count: the number of exposures to take for each filter
-            filters: a list of strings indicating the desired filters for each exposure
+            filters: a list of strings indicating the desired filters for each exposure,
+                    or a single comma-separated string
             binning: the desired CCD binning
             user: the username of the user who requested/created the session
+            defer_calibration: skip darks and biases so that the Executor can
+                    take them in one batch with the dome closed
+            adaptive: adjust the exposure time after the first frame of each
+                    target and filter towards target_snr
+            target_snr: the peak signal-to-noise ratio adaptive exposures aim for
+            min_exposure_time: the shortest exposure time adaptive mode may use
+            max_exposure_time: the longest exposure time adaptive mode may use
+            saturation: the pixel value in ADU at which the CCD saturates
+            quiet: don't log anything, i.e. for sessions that are only planned
         """
 
+        # whether to log to STDOUT
+        self.quiet = quiet
+
         # get user
         self.user = user
         
@@ -58,16 +79,37 @@ class Session(object):
         self.exposure_count = exposure_count
         self.__log("Exposure Count: "+str(self.exposure_count))
 
-        # Whether I, R, G filters should be used 
-        self.filters = filters
+        # Whether I, R, G filters should be used; submitters send a single
+        # string such as "clear" or "r,g,i", so split it into a list
+        if isinstance(filters, str):
+            filters = [f.strip() for f in filters.split(",") if f.strip()]
+        self.filters = list(filters)
         self.__log("Filters: "+str(self.filters))
 
         # What binning to use
         self.binning = binning
         self.__log("CCD Binning: "+str(self.binning))
 
+        # Whether darks and biases are left to the Executor
+        self.defer_calibration = defer_calibration
+
+        # Whether, and within what bounds, exposure times adapt to each target
+        self.adaptive = adaptive
+        self.target_snr = target_snr
+        self.min_exposure_time = min_exposure_time
+        self.max_exposure_time = max_exposure_time
+        self.saturation = saturation
+        if self.adaptive:
+            self.__log("Adaptive Exposure: SNR "+str(self.target_snr)+" within "+
+                       str(self.min_exposure_time)+"-"+str(self.max_exposure_time)+"s")
+
+        # The number of darks needed at each exposure time for each target
+        self.darks = {}
+
         # assign the telescope
-        self.telescope = Telescope.Telescope(nodark=nodark, nobias=nobias)
+        self.telescope = Telescope.Telescope(nodark=nodark, nobias=nobias,
+                                             exposure_time=exposure_time,
+                                             binning=binning)
 
         
     def execute(self) -> bool: 
@@ -96,54 +138,160 @@ class Session(object):
                            " telescope error. Skipping "+target+"...", color="red")
                 continue # try imaging next target
 
-            # variables to produce seo file format name
-            year = time.strftime("%Y", time.gmtime()) # 2016
-            month = time.strftime("%B", time.gmtime())[0:3].lower() # oct
-            day = time.strftime("%d", time.gmtime()) # 07
-            base_name = "-band_"+str(self.exposure_time)+"sec"
-            base_name += "_bin"+str(self.binning)+"_"+year+month+day+"_"
-            base_name += self.user+"_num"
-
-            # how many darks we have taken
-            dark_count = 0
+            # how many darks are needed, and have been interleaved with
+            # the science frames, at each exposure time
+            darks = {}
+            dark_count = {}
             
             # take exposures for each filter
-            for f in filters:
+            for f in self.filters:
 
                 #enable tracking as a precaution
                 self.telescope.enable_tracking()
                 
                 self.telescope.change_filter(f)
                 # take exposures! 
+                exposure_time = self.exposure_time
+                frames = {}
                 for n in range(self.exposure_count):
-                    filename = str(target)+"_"+str(f)+base_name+str(n)+"_seo"
+                    self.telescope.exposure_time = exposure_time
+                    filename = str(target)+"_"+str(f)+self.base_name(exposure_time)+str(n)+"_seo"
                     self.__log("Taking exposure {} for {}".format(n, target))
                     self.telescope.take_exposure(filename)
+                    frames[exposure_time] = frames.get(exposure_time, 0) + 1
+
+                    # adjust the remaining exposures from the first frame
+                    if self.adaptive and n == 0 and self.exposure_count > 1:
+                        exposure_time = self.adapt_exposure(filename+".fits", exposure_time)
+
+                # a dark for every frame at each exposure time in any one filter
+                for t in frames:
+                    darks[t] = max(darks.get(t, 0), frames[t])
 
-                filename = str(target)+"_dark"+base_name+str(dark_count)+"_seo"
-                dark_count += 1
+                # one dark after each filter at its final exposure time
+                dark_count[exposure_time] = dark_count.get(exposure_time, 0) + 1
+                darks[exposure_time] = max(darks[exposure_time], dark_count[exposure_time])
+                if self.defer_calibration:
+                    continue
+                filename = str(target)+"_dark"+self.base_name(exposure_time)
+                filename += str(dark_count[exposure_time]-1)+"_seo"
+                self.telescope.exposure_time = exposure_time
                 self.telescope.take_dark(filename)
 
+            self.darks[target] = darks
+            self.telescope.exposure_time = self.exposure_time
+
             # reset filter to clear
             self.telescope.change_filter('clear')
 
-            # take any leftover darks
-            for n in range(dark_count, self.exposure_count):
-                filename = str(target)+"_dark"+base_name+str(n)+"_seo"
-                self.telescope.take_dark(filename)
+            # darks and biases are taken by the Executor once the night is over
+            if not self.defer_calibration:
+
+                # take any leftover darks
+                for t in darks:
+                    self.telescope.exposure_time = t
+                    for n in range(dark_count.get(t, 0), darks[t]):
+                        filename = str(target)+"_dark"+self.base_name(t)+str(n)+"_seo"
+                        self.telescope.take_dark(filename)
+                self.telescope.exposure_time = self.exposure_time
 
-            # take 5*exposure_count biases
-            for n in range(5*self.exposure_count):
-                filename = str(target)+"_bias"+base_name+str(n)+"_seo"
-                self.telescope.take_bias(filename)
+                # take 5*exposure_count biases
+                base_name = self.base_name()
+                for n in range(5*self.exposure_count):
+                    filename = str(target)+"_bias"+base_name+str(n)+"_seo"
+                    self.telescope.take_bias(filename)
 
             self.close()
 
         return True
 
 
+    def base_name(self, exposure_time: float = None) -> str:
+        """ Returns the part of the seo file format name following the target
+        and frame type, up to the frame number, i.e. 
+        "-band_60sec_bin2_2016oct07_user_num", for frames of exposure_time
+        seconds (default the session's exposure time).
+        """
+        if exposure_time is None:
+            exposure_time = self.exposure_time
+        year = time.strftime("%Y", time.gmtime()) # 2016
+        month = time.strftime("%B", time.gmtime())[0:3].lower() # oct
+        day = time.strftime("%d", time.gmtime()) # 07
+        base_name = "-band_"+str(exposure_time)+"sec"
+        base_name += "_bin"+str(self.binning)+"_"+year+month+day+"_"
+        base_name += self.user+"_num"
+        return base_name
+
+
+    def calibration_frames(self) -> List[dict]:
+        """ Returns the darks and biases that execute() takes for each target
+        when calibration is not deferred, as dictionaries with the frame 'type'
+        ('dark' or 'bias'), 'exposure_time', 'binning', frame 'number' and
+        'filename'.
+        """
+        base_name = self.base_name()
+        frames = []
+        for target in self.targets:
+            # one dark per filter, topped up to exposure_count, at each
+            # exposure time execute() used (or will use, if not yet executed)
+            darks = self.darks.get(target, {self.exposure_time:
+                                            max(len(self.filters), self.exposure_count)})
+            if not self.telescope.nodark:
+                for t in darks:
+                    for n in range(darks[t]):
+                        frames.append({"type": "dark", "exposure_time": t,
+                                       "binning": self.binning, "number": n,
+                                       "filename": str(target)+"_dark"+self.base_name(t)+str(n)+"_seo"})
+
+            # 5*exposure_count biases
+            if not self.telescope.nobias:
+                for n in range(5*self.exposure_count):
+                    frames.append({"type": "bias", "exposure_time": self.exposure_time,
+                                   "binning": self.binning, "number": n,
+                                   "filename": str(target)+"_bias"+base_name+str(n)+"_seo"})
+
+        return frames
+
+
+    def adapt_exposure(self, filename: str, exposure_time: float) -> float:
+        """ Returns the exposure time that brings the brightest star in the
+        frame in filename, taken with exposure_time, to target_snr without
+        saturating its core (hot pixels and cosmic rays are ignored),
+        within the session's bounds. Assumes sky-limited noise, so the SNR
+        grows as the square root of the exposure time.
+        """
+        try:
+            stats = Image.quicklook(filename, saturation=self.saturation)
+        except (OSError, ValueError) as e:
+            self.__log("Unable to inspect {}: {}".format(filename, e), color="red")
+            return exposure_time
+
+        signal = stats["peak"] - stats["background"]
+        if stats["saturated"] > 0:
+            # a star core is clipped, so only know that we need much less light
+            new_time = exposure_time/4
+        elif signal <= 0:
+            new_time = self.max_exposure_time
+        else:
+            snr = signal/((signal + stats["noise"]**2)**0.5)
+            new_time = exposure_time*(self.target_snr/snr)**2
+
+            # keep the peak below 80% of saturation
+            headroom = 0.8*(self.saturation - stats["background"])/signal
+            new_time = min(new_time, exposure_time*headroom)
+
+        new_time = min(max(new_time, self.min_exposure_time), self.max_exposure_time)
+        new_time = round(new_time, 1)
+        self.__log("Quick-look: background {:.0f}, peak {:.0f}, {:.2%} saturated; "
+                   "exposure time now {}s".format(stats["background"], stats["peak"],
+                                                  stats["saturated"], new_time))
+        return new_time
+
+
     def __log(self, msg: str, color: str = "white") -> bool:
         """ Prints a log message to STDOUT. Returns True if successful, False
         otherwise.
         """
+        if self.quiet:
+            return True
         return Util.log(msg, color)    
@@ -3,32 +3,46 @@
 
 import typing
 import subprocess
+import json
+import os
+import time
 import Util
+import Image
+import Focus
+from Util import find_value
 
 class Telescope(object):
 
-    def __init__(self, nodark: bool = False, nobias: bool = False):
+    def __init__(self, nodark: bool = False, nobias: bool = False,
+                 timing_log: str = "telescope_timings.json",
+                 exposure_time: float = 0, binning: int = 2):
         # something here?
         self.nodark = nodark
         self.nobias = nobias
 
+        # exposure time and binning used for science frames and darks
+        self.exposure_time = exposure_time
+        self.binning = binning
+
+        # JSON file that the wall-clock time of every command is appended to;
+        # this is used by the Planner to calibrate its duration estimates
+        self.timing_log = timing_log
+
     def open_dome(self) -> bool:
         """ Checks that the weather is acceptable, and then opens the dome, 
         if it is not already open, and  also enables tracking. 
         """
         # check if dome is already open
-        if self.__dome_status() == True:
+        if self.dome_status() == True:
             return True
 
         # check that weather is OK to open
-        if self.__weather_ok() == True:
-            result = self.__run_command("openup nocloud &&" 
-                                        "keepopen maxtime=20000 slit"
-                                        "&& track on")
-            if result == True: # everything was good
-                return True
-            else: # one of the commands failed
-                return False
+        if self.weather_ok() == True:
+            # __run_command exits if any of the commands fail
+            self.__run_command("openup nocloud &&" 
+                               "keepopen maxtime=20000 slit"
+                               "&& track on")
+            return True
         else:
             return False
 
@@ -47,12 +61,12 @@ class Telescope(object):
         """
 
         # check sun
-        sun = self.__run_command("sun")
-        if float(find_value("alt", sun)) >= -1.0:
+        sun = find_value("alt", self.__query("sun"))
+        if sun == "" or float(sun) >= -1.0:
             return False
 
         # sun is good - check for weather
-        weather = self.__run_command("tx taux")
+        weather = self.__query("tx taux")
         #meteorology = self.__run_command("tx mets")
 
         # if this cmd failed, return false to be safe
@@ -64,8 +78,8 @@ class Telescope(object):
         rain = 1 # default to being raining just in case
         cloud = 1 # default to being cloudy just in case
         # humidity = 100 # default to being 100% humid just in case
-        rain = float(find_value("rain", weather)) # find rain=val
-        cloud = float(find_value("cloud", weather)) # find cloud=val
+        rain = float(find_value("rain", weather) or rain) # find rain=val
+        cloud = float(find_value("cloud", weather) or cloud) # find cloud=val
         # humidity = float(find_value("humidity", meteorology)) # find humidity=val
 
         if rain == 0 and cloud < 0.4:
@@ -83,7 +97,7 @@ class Telescope(object):
         """ Checks whether the slit is open or closed. Returns True if open, 
         False if closed.
         """
-        slit = self.__run_command("tx slit")
+        slit = self.__query("tx slit")
         result = find_value("slit", slit)
         if result == "open":
             return True
@@ -97,15 +111,17 @@ class Telescope(object):
         successfully (object was visible), and returns False if unable to set
         telescope (failure, object not visible).
         """
-        if self.__target_visible(target) == True:
+        if self.target_visible(name) == True:
             # Check if we're using coordinates or target names
-            if not target.contains(","):
-                cmd = "catalog "+target+" | dopoint"
-                return self.__run__command(cmd)
-
+            if "," not in name:
+                cmd = "catalog "+name+" | dopoint"
             else:
-                cmd = "tx point ra="+target[1]+" dec="+target[2]+" equinox="+target[3]
-                return self.__run_command(cmd)
+                ra, dec, equinox = name.split(",")
+                cmd = "tx point ra="+ra+" dec="+dec+" equinox="+equinox
+
+            # __run_command exits if the telescope fails to point
+            self.__run_command(cmd)
+            return True
 
         return False
                     
@@ -114,20 +130,16 @@ class Telescope(object):
         in altitude. Returns True if visible and >40, False otherwise
         """
         # Check if we're using coordinates or target names
-        if not target.contains(","):
-            cmd = "catalog "+target+" | altaz"
-            altaz = self.__run_command(cmd).split()
-            if float(find_value("alt", altaz)) >= 40:
-                return True
-            return False
-
+        if "," not in name:
+            cmd = "catalog "+name+" | altaz"
         else:
-            target.split(",")
-            cmd = "ra="+target[0]+" dec="+target[1]+" equinox="+target[2]+" | altaz"
-            altaz = self.__run_command(cmd).split()
-            if float(find_value("alt", altazs)) >= 40:
-                return True
-            return False
+            ra, dec, equinox = name.split(",")
+            cmd = "ra="+ra+" dec="+dec+" equinox="+equinox+" | altaz"
+
+        alt = find_value("alt", self.__query(cmd))
+        if alt != "" and float(alt) >= 40:
+            return True
+        return False
 
 
     def current_filter(self) -> str:
@@ -155,7 +167,7 @@ class Telescope(object):
         file with the specified filename. Returns True if imaging
         was successful, False otherwise. 
         """
-        cmd = "image time="+self.exposure_time+" bin="+self.binning+" "
+        cmd = "image time="+str(self.exposure_time)+" bin="+str(self.binning)+" "
         cmd += "outfile="+filename+".fits"
         status = self.__run_command(cmd)
         self.__log("Saved exposure frame to "+filename, color="cyan")
@@ -167,7 +179,7 @@ class Telescope(object):
         filename. Returns True if imaging was successful, False otherwise. 
         """
         if not self.nobias:
-            cmd = "image time=0.5 bin="+self.binning+" "
+            cmd = "image time=0.5 bin="+str(self.binning)+" "
             cmd += "outfile="+filename+"_bias.fits"
             status = self.__run_command(cmd)
             self.__log("Saved bias frame to "+filename, color="cyan")
@@ -181,7 +193,7 @@ class Telescope(object):
         was successful, False otherwise. 
         """
         if not self.nodark:
-            cmd = "image time="+self.exposure_time+" bin="+self.binning+" dark "
+            cmd = "image time="+str(self.exposure_time)+" bin="+str(self.binning)+" dark "
             cmd += "outfile="+filename+"_dark.fits"
             status = self.__run_command(cmd)
             self.__log("Saved dark frame to "+filename, color="cyan")
@@ -192,8 +204,110 @@ class Telescope(object):
     def enable_tracking(self) -> bool:
         return self.__run_command("tx track on")
     
-    def focus(self) -> bool:
-        pass
+    def focus_position(self) -> int:
+        """ Returns the current focuser position, or None if it could not be
+        read.
+        """
+        position = find_value("pos", self.__query("tx focus"))
+        if position == "":
+            return None
+        return int(float(position))
+
+
+    def set_focus(self, position: int) -> bool:
+        """ Moves the focuser to the specified position. Returns True if
+        successful, False otherwise.
+        """
+        return self.__run_command("tx focus pos="+str(int(position)))
+
+
+    def temperature(self) -> float:
+        """ Returns the outside temperature in degrees C, or None if it could
+        not be read.
+        """
+        temp = find_value("temp", self.__query("tx taux"))
+        if temp == "":
+            return None
+        return float(temp)
+
+
+    def focus(self, exposure_time: float = 5.0, step: int = 50, points: int = 5,
+              max_exposures: int = 9, size: int = 512, radius: int = 12) -> bool:
+        """ Focuses the telescope on the current field. Short exposures are
+        taken at points focuser positions step apart around the current one,
+        and a hyperbolic V-curve is fit to the star FWHM, measured within
+        radius pixels of each star in the central size x size pixels. If the
+        fitted minimum is outside the positions taken, the next exposure is
+        taken one step beyond it (at most points steps out) so that it is
+        bracketed, up to max_exposures exposures. Returns True if the
+        telescope was moved to a fitted best focus, False otherwise.
+        """
+        start = self.focus_position()
+        if start is None:
+            self.__log("Unable to read the focuser position", color="red")
+            return False
+
+        positions = [start + (n - points//2)*step for n in range(points)]
+        measured = {}
+        while len(measured) < max_exposures:
+            for position in positions:
+                if position in measured or len(measured) >= max_exposures:
+                    continue
+                filename = "focus_"+str(position)
+                self.set_focus(position)
+                cmd = "image time="+str(exposure_time)+" bin="+str(self.binning)+" "
+                cmd += "outfile="+filename+".fits"
+                self.__run_command(cmd)
+                try:
+                    measured[position] = Image.measure_fwhm(filename+".fits", size,
+                                                             radius=radius)
+                except (OSError, ValueError) as e:
+                    self.__log("Unable to measure {}: {}".format(filename, e), color="red")
+                    measured[position] = float("nan")
+
+                # the frame is only needed for its FWHM
+                try:
+                    os.remove(filename+".fits")
+                except OSError:
+                    pass
+                self.__log("FWHM at focus {} is {:.2f}px".format(position,
+                                                                 measured[position]))
+
+            tried = sorted(measured)
+            fit = Focus.fit_vcurve(tried, [measured[p] for p in tried])
+            if fit is not None and tried[0] <= fit[0] <= tried[-1]:
+                self.__log("Best focus at {:.0f} with FWHM {:.2f}px from {} "
+                           "exposures".format(fit[0], fit[1], len(measured)),
+                           color="green")
+                self.set_focus(round(fit[0]))
+                return True
+
+            # step past the fitted minimum, or half a bracket towards the
+            # sharper end if the points were too far out of focus to fit
+            if fit is not None:
+                upwards = fit[0] > tried[-1]
+            else:
+                upwards = measured[tried[-1]] < measured[tried[0]]
+            jump = max(1, points//2)*step
+            if upwards:
+                target = step*round(fit[0]/step) + step if fit else tried[-1] + jump
+                positions = [int(min(max(target, tried[-1] + step),
+                                     tried[-1] + points*step))]
+            else:
+                target = step*round(fit[0]/step) - step if fit else tried[0] - jump
+                positions = [int(max(min(target, tried[0] - step),
+                                     tried[0] - points*step))]
+
+        # no minimum was bracketed; fall back on the sharpest frame taken
+        good = [p for p in measured if measured[p] == measured[p]]
+        if good:
+            best = min(good, key=lambda p: measured[p])
+        else:
+            best = start
+        self.__log("Unable to fit focus, moving to {}".format(best), color="yellow")
+        self.set_focus(best)
+        return False
+
 
     
     def enable_flats(self) -> bool:
@@ -215,6 +329,21 @@ class Telescope(object):
         else:
             pass
 
+    def __record_timing(self, command: str, duration: float) -> bool:
+        """ Appends the wall-clock duration of a command to the timing log.
+        Returns True if successful, False otherwise. 
+        """
+        if not self.timing_log:
+            return True
+        try:
+            with open(self.timing_log, "a") as timings:
+                timings.write(json.dumps({"command": command,
+                                          "duration": duration})+"\n")
+            return True
+        except OSError:
+            self.__log("Unable to record command timing", color="yellow")
+            return False
+
     def __log(self, msg: str, color: str = "white") -> bool:
         """ Prints a log message to STDOUT. Returns True if successful, False
         otherwise.
@@ -222,13 +351,25 @@ class Telescope(object):
         return Util.log(msg, color)    
 
     
+    def __query(self, command: str) -> str:
+        """ Executes a status command and returns its STDOUT as a string.
+        """
+        output = self.__run_command(command)
+        if isinstance(output, bytes):
+            return output.decode("utf-8", "replace")
+        return str(output)
+
+    
     def __run_command(self, command: str) -> str:
         """ Executes a shell command either locally, or remotely via ssh. 
         Returns the byte string representing the captured STDOUT
         """
         self.__log("Executing {}".format(command), color="magenta")
         try:
-            return subprocess.check_output(command)
+            start = time.time()
+            output = subprocess.check_output(command)
+            self.__record_timing(command, time.time() - start)
+            return output
         except:
             self.__log("Failed while executing {}".format(command), color="red")
             self.__log("Please manually close the dome by running"
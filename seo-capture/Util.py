@@ -1,5 +1,7 @@
 import typing
 import time
+import math
+import datetime
 
 def find_value(arg: str, string: str) -> str:
     """ Searches for "arg=X" in the string and returns X
@@ -23,3 +25,86 @@ def log( msg: str, color: str = "white") -> bool:
         print(log)
         return True
 
+
+def night_date(t: float, longitude: float) -> datetime.date:
+    """ Returns the date of the observing night containing the UNIX time t. 
+    Nights run from local noon to local noon (mean solar time at longitude, 
+    degrees east positive), and are labelled by the date of the evening. 
+    """
+    offset = longitude/360.0*86400.0 - 12*3600
+    return datetime.datetime.utcfromtimestamp(t + offset).date()
+
+
+def twilight(date: datetime.date, latitude: float, longitude: float,
+             altitude: float = -12.0) -> typing.Tuple[float, float]:
+    """ Returns the (evening, morning) UNIX times at which the sun crosses
+    altitude (degrees) on the observing night starting on date. The default of
+    -12 degrees is nautical twilight. Returns None if the sun never reaches 
+    that altitude on this night. 
+    """
+    def crossings(n: int) -> typing.Tuple[float, float]:
+        """ Sunrise equation for the solar transit on day n after J2000; returns
+        the (rise, set) Julian dates, or None if the sun never crosses. 
+        """
+        jstar = n - longitude/360.0
+        m = (357.5291 + 0.98560028*jstar) % 360
+        mr = math.radians(m)
+        c = 1.9148*math.sin(mr) + 0.02*math.sin(2*mr) + 0.0003*math.sin(3*mr)
+        lam = math.radians((m + c + 180 + 102.9372) % 360)
+        transit = 2451545.0 + jstar + 0.0053*math.sin(mr) - 0.0069*math.sin(2*lam)
+        dec = math.asin(math.sin(lam)*math.sin(math.radians(23.4397)))
+        lat = math.radians(latitude)
+        cosw = ((math.sin(math.radians(altitude)) - math.sin(lat)*math.sin(dec))
+                / (math.cos(lat)*math.cos(dec)))
+        if cosw < -1 or cosw > 1:
+            return None
+        w = math.degrees(math.acos(cosw))
+        return (transit - w/360.0, transit + w/360.0)
+
+    def to_unix(jd: float) -> float:
+        return (jd - 2440587.5)*86400.0
+
+    n = (date - datetime.date(2000, 1, 1)).days
+    today = crossings(n)
+    tomorrow = crossings(n+1)
+    if today is None or tomorrow is None:
+        return None
+
+    return (to_unix(today[1]), to_unix(tomorrow[0]))
+
+
+class TokenBucket(object):
+    """ A token-bucket rate limiter; tokens refill continuously at rate per
+    second up to capacity, and each request consumes one token. 
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def refill(self) -> float:
+        """ Adds the tokens accumulated since the last refill and returns the
+        number of tokens now available. 
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+        return self.tokens
+
+    def consume(self) -> bool:
+        """ Consumes a token. Returns True if one was available, False if the
+        request should be refused. 
+        """
+        if self.refill() >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """ Returns the number of seconds until a token will be available. 
+        """
+        if self.rate <= 0:
+            return float("inf")
+        return max(0.0, (1 - self.refill())/self.rate)
@@ -0,0 +1,7 @@
+# The seo-capture modules import each other by their bare names, so put the
+# source directory on the path for the tests
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "seo-capture"))
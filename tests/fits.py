@@ -0,0 +1,38 @@
+# Helpers for writing synthetic FITS frames in the tests
+import numpy as np
+
+
+def write_fits(filename: str, data: np.ndarray, bitpix: int = 16,
+               bzero: float = 32768) -> None:
+    """ Writes data as the primary image of a FITS file.
+    """
+    dtype = {16: ">i2", -32: ">f4"}[bitpix]
+    cards = ["SIMPLE  =                    T", "BITPIX  = {:20d}".format(bitpix),
+             "NAXIS   =                    2",
+             "NAXIS1  = {:20d}".format(data.shape[1]),
+             "NAXIS2  = {:20d}".format(data.shape[0])]
+    if bitpix > 0:
+        cards.append("BZERO   = {:20.1f} / offset".format(bzero))
+        data = np.rint(data - bzero)
+    cards.append("END")
+    header = "".join(card.ljust(80) for card in cards)
+    header = header.ljust(2880*((len(header) + 2879)//2880))
+    raw = data.astype(dtype).tobytes()
+    raw += b"\0"*((-len(raw)) % 2880)
+    with open(filename, "wb") as fits:
+        fits.write(header.encode("ascii") + raw)
+
+
+def star_field(shape, stars, fwhm: float, sky: float = 1000.0,
+               seed: int = 1) -> np.ndarray:
+    """ Returns a noisy frame with Gaussian stars of the given FWHM, where
+    stars is a list of (row, column, flux).
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    sigma = fwhm/2.3548
+    image = np.full(shape, sky)
+    for row, col, flux in stars:
+        image += flux/(2*np.pi*sigma**2)*np.exp(
+            -((yy - row)**2 + (xx - col)**2)/(2*sigma**2))
+    return np.clip(rng.poisson(image).astype(float), 0, 65535)
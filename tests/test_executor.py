@@ -0,0 +1,41 @@
+import time
+import Executor
+
+
+def make_executor(calibrate_at: str, window: tuple) -> Executor.Executor:
+    """ An executor with an empty queue, without a config.yaml, that records
+    its calibration batches instead of taking them.
+    """
+    executor = Executor.Executor.__new__(Executor.Executor)
+    executor.sessions = []
+    executor.defer_calibration = True
+    executor.calibrate_at = calibrate_at
+    executor.calibrated = set()
+    executor.autofocus = False
+    executor.dark_window = lambda t=None: window
+    executor.batches = []
+    executor.execute_calibration = lambda until=None: executor.batches.append(until) or True
+    return executor
+
+
+def test_dusk_calibration_stops_at_twilight():
+    now = time.time()
+    executor = make_executor("dusk", (now + 3600, now + 7200))
+    assert executor.execute_queue()
+    assert executor.batches == [now + 3600, None]
+
+
+def test_dusk_calibration_postponed_in_dark_window(capsys):
+    now = time.time()
+    executor = make_executor("dusk", (now - 60, now + 3600))
+    assert executor.execute_queue()
+    assert executor.batches == [None]
+    assert "postponing calibration" in capsys.readouterr().out
+
+
+def test_dawn_calibration_warns_in_dark_window(capsys):
+    now = time.time()
+    executor = make_executor("dawn", (now - 60, now + 3600))
+    assert executor.execute_queue()
+    assert executor.batches == [None]
+    assert "using dark time" in capsys.readouterr().out
@@ -0,0 +1,100 @@
+import os
+import time
+import types
+import numpy as np
+import Executor
+import Focus
+import Telescope
+from fits import write_fits, star_field
+
+
+def test_fit_vcurve_recovers_best_focus():
+    positions = np.arange(800, 1401, 100)
+    fwhms = 3.0*np.sqrt(1 + ((positions - 1130)/80.0)**2)
+    c, a = Focus.fit_vcurve(list(positions), list(fwhms))
+    assert abs(c - 1130) < 1
+    assert abs(a - 3.0) < 0.01
+
+
+def test_fit_vcurve_rejects_unbracketed_points():
+    # too few measurable points, and a curve with a maximum
+    assert Focus.fit_vcurve([0, 100, 200], [3.0, float("nan"), 4.0]) is None
+    assert Focus.fit_vcurve([0, 100, 200], [3.0, 4.0, 3.0]) is None
+
+
+class SimulatedTelescope(Telescope.Telescope):
+    """ A telescope whose focuser and camera are simulated, with best focus
+    at the given position.
+    """
+
+    def __init__(self, best: int, position: int):
+        super().__init__(timing_log="")
+        self.best = best
+        self.position = position
+        self.frames = []
+        self.temp = 10.0
+        self.pointed = None
+
+    def _Telescope__run_command(self, command: str) -> bytes:
+        if command.startswith("tx focus pos="):
+            self.position = int(command.split("=")[1])
+        elif command == "tx focus":
+            return "done focus pos={}".format(self.position).encode()
+        elif command == "tx slit":
+            return b"done slit slit=open"
+        elif command == "tx taux":
+            return "done taux temp={:.1f}".format(self.temp).encode()
+        elif command.endswith("| altaz"):
+            return b"alt=60.0 az=120.0"
+        elif command.endswith("| dopoint"):
+            self.pointed = command.split()[1]
+        elif command.startswith("image"):
+            filename = command.split("outfile=")[1]
+            fwhm = 3.0*np.sqrt(1 + ((self.position - self.best)/80.0)**2)
+            stars = [(r, c, 200000.0) for r in range(40, 220, 45)
+                     for c in range(40, 220, 45)]
+            write_fits(filename, star_field((256, 256), stars, fwhm, seed=self.position))
+            self.frames.append(filename)
+        return b""
+
+
+def test_focus_moves_to_best_focus(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    telescope = SimulatedTelescope(best=1130, position=1000)
+
+    assert telescope.focus(size=256) is True
+    assert abs(telescope.position - 1130) < 30
+
+    # the focus frames are removed once measured
+    assert telescope.frames
+    assert not any(os.path.exists(frame) for frame in telescope.frames)
+
+
+def test_focus_if_due_on_time_and_temperature(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    telescope = SimulatedTelescope(best=1130, position=1000)
+    session = types.SimpleNamespace(telescope=telescope, targets=["m31"])
+    executor = Executor.Executor.__new__(Executor.Executor)
+    executor.focus_interval = 3600
+    executor.focus_temperature = 1.0
+    executor.last_focus_time = None
+    executor.last_focus_temp = None
+
+    # the first session is always focused
+    assert executor.focus_if_due(session) is True
+    assert telescope.pointed == "m31"
+    assert abs(telescope.position - 1130) < 30
+
+    # not again until the interval passes or the temperature drifts
+    telescope.best = 1300
+    telescope.temp = 10.5
+    assert executor.focus_if_due(session) is False
+    telescope.temp = 11.5
+    assert executor.focus_if_due(session) is True
+    assert abs(telescope.position - 1300) < 30
+
+    executor.last_focus_time = time.time() - 3601
+    telescope.best = 1130
+    assert executor.focus_if_due(session) is True
+    assert abs(telescope.position - 1130) < 30
+    assert executor.last_focus_temp == 11.5
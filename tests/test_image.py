@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import Image
+import Session
+from fits import write_fits, star_field
+
+
+def test_quicklook_finds_saturated_star_core(tmp_path):
+    # one bright star whose core saturates in a handful of pixels
+    filename = str(tmp_path/"bright.fits")
+    write_fits(filename, star_field((512, 512), [(201, 313, 3e6)], fwhm=3.0))
+
+    stats = Image.quicklook(filename, saturation=60000.0)
+    assert abs(stats["background"] - 1000) < 5
+    assert stats["peak"] == 65535
+    assert 0 < stats["saturated"] < 1e-3
+
+
+def test_adapt_exposure_shortens_bright_frames(tmp_path):
+    session = Session.Session(targets=["m31"], exposure_time=60,
+                              exposure_count=5, adaptive=True)
+
+    saturated = str(tmp_path/"saturated.fits")
+    write_fits(saturated, star_field((512, 512), [(201, 313, 8e5)], fwhm=3.0))
+    assert session.adapt_exposure(saturated, 60) < 60
+
+    # an unsaturated star peaking near 41k must not be lengthened
+    bright = str(tmp_path/"bright.fits")
+    write_fits(bright, star_field((512, 512), [(201, 313, 2.8e5)], fwhm=2.5))
+    stats = Image.quicklook(bright)
+    assert 35000 < stats["peak"] < 50000
+    assert stats["saturated"] == 0
+    assert session.adapt_exposure(bright, 60) <= 60
+
+
+def test_read_fits_applies_bzero(tmp_path):
+    filename = str(tmp_path/"frame.fits")
+    data = np.arange(300*200, dtype=float).reshape(300, 200) % 60000
+    write_fits(filename, data)
+
+    header, offset = Image.read_header(filename)
+    assert header["NAXIS1"] == "200" and header["NAXIS2"] == "300"
+    assert offset == 2880
+
+    frame = Image.read_fits(filename)
+    assert frame.shape == (300, 200)
+    assert frame.bzero == 32768
+    assert np.array_equal(Image.physical(frame, frame[:]), data)
+
+
+def test_read_fits_rejects_truncated_files(tmp_path):
+    filename = str(tmp_path/"short.fits")
+    with open(filename, "wb") as fits:
+        fits.write(b"SIMPLE  =                    T".ljust(80))
+    with pytest.raises(ValueError):
+        Image.read_header(filename)
+
+
+def test_measure_fwhm_of_star_field(tmp_path):
+    filename = str(tmp_path/"stars.fits")
+    stars = [(r, c, 50000.0) for r in range(60, 460, 80) for c in range(60, 460, 80)]
+    write_fits(filename, star_field((512, 512), stars, fwhm=4.0))
+
+    pixels = Image.subframe(Image.read_fits(filename), 512)
+    assert len(Image.find_sources(pixels)) == len(stars)
+    assert abs(Image.measure_fwhm(filename, radius=8) - 4.0) < 0.4
+
+
+def test_quicklook_ignores_hot_pixels_and_cosmic_rays(tmp_path):
+    filename = str(tmp_path/"defects.fits")
+    frame = star_field((512, 512), [(201, 313, 1e5)], fwhm=3.0)
+    frame[50, 60] = 65535
+    frame[400, 100:102] = 65535
+    write_fits(filename, frame)
+
+    stats = Image.quicklook(filename)
+    assert stats["saturated"] == 0
+    assert 5000 < stats["peak"] < 20000
+
+    session = Session.Session(targets=["m31"], exposure_time=60,
+                              exposure_count=5, adaptive=True)
+    assert session.adapt_exposure(filename, 60) > 60
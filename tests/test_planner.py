@@ -0,0 +1,107 @@
+import json
+import Planner
+import Session
+
+
+def make_planner(**kwargs) -> Planner.Planner:
+    """ A planner with the default costs that ignores any recorded timings.
+    """
+    return Planner.Planner(timing_log="", **kwargs)
+
+
+def test_estimate_session_with_string_filters():
+    # 1 target, 2x60s in clear, as sent by seo-submit
+    session = Session.Session(targets=["m31"], exposure_time=60,
+                              exposure_count=2, filters="clear")
+    planner = make_planner()
+
+    # slew + filter + 2 frames + reset to clear
+    science = 60 + 10 + 2*75 + 10
+    # 2 darks and 10 biases
+    calibration = 2*75 + 10*15.5
+    assert planner.estimate_session(session) == science + calibration
+
+
+def test_estimate_session_deferred_calibration():
+    session = Session.Session(targets=["m31", "m33"], exposure_time=60,
+                              exposure_count=2, filters=["r", "g"],
+                              defer_calibration=True)
+    planner = make_planner()
+    assert planner.estimate_session(session) == 2*(60 + 2*(10 + 2*75) + 10)
+
+
+def test_plan_flags_sessions_past_dawn():
+    planner = make_planner()
+    start, end = planner.dark_window(1760900000)
+    session = Session.Session(targets=["m31"], exposure_time=600,
+                              exposure_count=10, filters="r,g,i")
+    duration = planner.estimate_session(session)
+
+    plan = planner.plan([session]*50, start)
+    assert plan[0]["start"] == start
+    assert plan[0]["fits"]
+    assert not plan[-1]["fits"]
+    assert plan[-1]["overrun"] == plan[-1]["end"] - end
+    assert plan[1]["start"] == start + duration
+
+
+def test_calibrate_from_timings(tmp_path):
+    timings = tmp_path/"timings.json"
+    with open(str(timings), "w") as log:
+        for record in [{"command": "image time=60 bin=2 outfile=a.fits", "duration": 72},
+                       {"command": "image time=30 bin=2 outfile=b.fits", "duration": 40},
+                       {"command": "pfilter r-band", "duration": 4},
+                       {"command": "tx point ra=1 dec=2 equinox=2000", "duration": 30},
+                       {"command": "catalog m31 | dopoint", "duration": 50},
+                       {"command": "catalog m31 | altaz", "duration": 1},
+                       {"command": "catalog m33 | altaz", "duration": 1}]:
+            log.write(json.dumps(record)+"\n")
+        log.write("not json\n")
+
+    planner = Planner.Planner(timing_log=str(timings))
+    assert planner.readout_time == 11
+    assert planner.filter_time == 4
+    assert planner.slew_time == 40
+
+
+def test_estimate_adaptive_session_at_upper_bound():
+    fixed = Session.Session(targets=["m31"], exposure_time=60,
+                            exposure_count=2, filters="clear",
+                            max_exposure_time=300)
+    adaptive = Session.Session(targets=["m31"], exposure_time=60,
+                               exposure_count=2, filters="clear",
+                               adaptive=True, max_exposure_time=300)
+    planner = make_planner()
+
+    # 2 science frames and 2 darks, each up to 240s longer
+    assert (planner.estimate_session(adaptive) ==
+            planner.estimate_session(fixed) + 4*240)
+
+
+def test_plan_queue_is_quiet(tmp_path, capsys):
+    queue = tmp_path/"queue.json"
+    request = {"targets": ["m31"], "exposure_time": 60, "exposure_count": 2,
+               "filters": ["r"], "binning": 2, "user": "alice"}
+    with open(str(queue), "w") as f:
+        for n in range(200):
+            f.write(json.dumps(request)+"\n")
+
+    plan = make_planner().plan_queue(str(queue), 1760900000)
+    assert len(plan) == 200
+    assert capsys.readouterr().out == ""
+
+
+def test_plan_calibration_counts_shared_frames_once():
+    sessions = [Session.Session(targets=["m31"], exposure_time=60,
+                                exposure_count=2, filters="clear")
+                for n in range(3)]
+    planner = make_planner()
+    calibration = planner.plan_calibration(sessions, 1760900000)
+
+    # 2 darks and 10 biases shared by all three sessions
+    assert calibration["frames"] == 12
+    assert calibration["duration"] == 2*75 + 10*15.5
+
+    # sunset to nautical twilight is roughly an hour at Sonoma in October
+    assert 2400 < calibration["dusk"] < 4200
+    assert 2400 < calibration["dawn"] < 4200
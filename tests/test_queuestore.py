@@ -0,0 +1,119 @@
+import calendar
+import datetime
+import gzip
+import os
+import pytest
+import QueueStore
+
+
+def utc(*args) -> float:
+    return float(calendar.timegm(args + (0,)*(6 - len(args))))
+
+
+def night(day: int) -> datetime.date:
+    return datetime.date(2026, 10, day)
+
+
+def test_ingest_night_rolls_over_at_twilight(tmp_path):
+    store = QueueStore.QueueStore(str(tmp_path))
+
+    # evening nautical twilight at Sonoma is about 02:24 UTC
+    assert store.ingest_night(utc(2026, 10, 19, 22)) == night(19)
+    assert store.ingest_night(utc(2026, 10, 20, 3)) == night(20)
+    assert store.current_night(utc(2026, 10, 20, 3)) == night(19)
+
+
+def test_rotate_archives_finished_nights(tmp_path):
+    store = QueueStore.QueueStore(str(tmp_path), "seo_")
+    for day in (18, 19, 20):
+        store.append(night(day), {"user": "alice", "night": day})
+        store.append(night(day), {"user": "bob", "night": day})
+
+    assert store.rotate(utc(2026, 10, 21, 22)) == night(21)
+
+    # one closed night is kept live, along with tonight's new partition
+    assert store.live_nights() == [night(20), night(21)]
+    assert not os.path.exists(store.path(night(18)))
+    index = store.read_index()
+    assert sorted(index) == ["2026-10-18", "2026-10-19"]
+    assert index["2026-10-18"]["file"] == "seo_2026-10-18_imaging_queue.json.gz"
+    assert index["2026-10-18"]["requests"] == 2
+    with gzip.open(os.path.join(store.archive_dir, index["2026-10-19"]["file"]), "rt") as f:
+        assert len(f.readlines()) == 2
+
+
+def test_archive_appends_to_an_archived_night(tmp_path):
+    store = QueueStore.QueueStore(str(tmp_path))
+    store.append(night(18), {"user": "alice"})
+    store.archive(night(18))
+    store.append(night(18), {"user": "bob"})
+    store.archive(night(18))
+
+    assert store.read_index()["2026-10-18"]["requests"] == 2
+    users = [request["user"] for _, request in store.requests(night(18), night(18))]
+    assert users == ["alice", "bob"]
+    assert not os.path.exists(os.path.join(store.archive_dir,
+                                           store.filename(night(18))+".gz.tmp"))
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.mark.parametrize("function, call", [
+    ("replace", 1), ("write_index", 1), ("replace", 2), ("remove", 1),
+    ("write_index", 2)])
+def test_interrupted_archive_is_finished_once(tmp_path, monkeypatch, function, call):
+    store = QueueStore.QueueStore(str(tmp_path))
+    store.append(night(18), {"user": "alice"})
+    store.archive(night(18))
+    store.append(night(18), {"user": "bob"})
+    store.append(night(18), {"user": "carol"})
+
+    # crash on the given call of one of the steps of the second archive
+    target = QueueStore.os if function in ("replace", "remove") else store
+    original = getattr(target, function)
+    calls = []
+    def crash(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == call:
+            raise Crash()
+        return original(*args, **kwargs)
+    monkeypatch.setattr(target, function, crash)
+    with pytest.raises(Crash):
+        store.archive(night(18))
+    monkeypatch.setattr(target, function, original)
+
+    store.rotate(utc(2026, 10, 21, 22))
+    users = [request["user"] for _, request in store.requests(night(18), night(18))]
+    assert users == ["alice", "bob", "carol"]
+    assert store.read_index()["2026-10-18"]["requests"] == 3
+    assert "pending" not in store.read_index()["2026-10-18"]
+    assert night(18) not in store.live_nights(".archiving")
+
+
+def test_requests_spans_live_and_archived_nights(tmp_path):
+    store = QueueStore.QueueStore(str(tmp_path))
+    for day in (17, 18, 19, 20):
+        store.append(night(day), {"night": day})
+    store.archive(night(17))
+    store.archive(night(18))
+
+    nights = [(n, request["night"]) for n, request in store.requests(night(18), night(21))]
+    assert nights == [(night(18), 18), (night(19), 19), (night(20), 20)]
+
+
+def test_rotate_expires_old_archives(tmp_path):
+    store = QueueStore.QueueStore(str(tmp_path), keep_nights=0, keep_archives=2)
+    for day in (15, 16, 17, 18):
+        store.append(night(day), {"night": day})
+
+    store.rotate(utc(2026, 10, 19, 22))
+
+    # archives from before the last two nights are deleted
+    assert sorted(store.read_index()) == ["2026-10-17", "2026-10-18"]
+    assert sorted(os.listdir(store.archive_dir)) == [
+        "2026-10-17_imaging_queue.json.gz", "2026-10-18_imaging_queue.json.gz",
+        "index.json"]
+    assert store.expire(night(30)) == 2
+    assert store.read_index() == {}
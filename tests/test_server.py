@@ -0,0 +1,158 @@
+import json
+import pytest
+import Server
+import Util
+
+
+def request(**fields) -> dict:
+    msg = {"magic": 1, "user": "alice", "targets": ["m31"], "exposure_time": 60,
+           "exposure_count": 2, "filters": "clear", "binning": 2}
+    msg.update(fields)
+    return msg
+
+
+def test_normalise_request_coerces_fields():
+    normal = Server.normalise_request(request(exposure_time="60",
+                                              exposure_count="2",
+                                              filters="r, g,i"))
+    assert normal["exposure_time"] == 60.0
+    assert isinstance(normal["exposure_time"], float)
+    assert normal["exposure_count"] == 2
+    assert normal["filters"] == ["r", "g", "i"]
+    assert normal["adaptive"] is False
+    assert normal["max_exposure_time"] == 600.0
+
+
+@pytest.mark.parametrize("fields", [
+    {"targets": "m31"},
+    {"targets": []},
+    {"targets": ["m31", 3]},
+    {"exposure_time": "sixty"},
+    {"exposure_time": -5},
+    {"exposure_time": None},
+    {"exposure_count": True},
+    {"filters": ""},
+    {"adaptive": "yes"},
+    {"min_exposure_time": 10, "max_exposure_time": 5},
+])
+def test_normalise_request_rejects(fields):
+    with pytest.raises(ValueError):
+        Server.normalise_request(request(**fields))
+
+
+def make_server(tmp_path) -> Server.Server:
+    """ A Server with default limits and a queue store in tmp_path, without
+    reading config.yaml or binding a socket.
+    """
+    server = Server.Server.__new__(Server.Server)
+    server.enabled = True
+    server.max_targets = 20
+    server.max_exposures = 500
+    server.max_queue_requests = 200
+    server.max_exposure_time = 600
+    server.max_target_snr = 1000
+    server.max_message_bytes = 16384
+    server.magic = 1
+    server.magic_admin = 2
+    server.rate = 1/60
+    server.burst = 10
+    server.buckets = {}
+    server.global_bucket = Util.TokenBucket(1, 20)
+    server.store = Server.QueueStore.QueueStore(str(tmp_path))
+    server.night = None
+    server.planner = Server.Planner.Planner(timing_log="")
+    return server
+
+
+def encode(msg: dict) -> bytes:
+    """ Encodes a message the way seo-submit sends it.
+    """
+    return json.dumps(json.dumps(msg)).encode()
+
+
+def test_admit_request_returns_normalised_request(tmp_path):
+    reply, normal = make_server(tmp_path).admit_request(request(exposure_time="60"))
+    assert reply == ""
+    assert normal["exposure_time"] == 60.0
+
+
+@pytest.mark.parametrize("fields", [
+    {"targets": ["m{}".format(n) for n in range(21)]},
+    {"exposure_count": 200, "filters": "r,g,i"},
+    {"exposure_time": 1200},
+    {"adaptive": True, "max_exposure_time": 1e6},
+    {"adaptive": True, "target_snr": 1e5},
+])
+def test_admit_request_enforces_limits(tmp_path, fields):
+    reply, normal = make_server(tmp_path).admit_request(request(**fields))
+    assert reply.startswith("rejected")
+    assert normal is None
+
+
+def test_admit_request_ignores_adaptive_bounds_when_not_adaptive(tmp_path):
+    server = make_server(tmp_path)
+    server.max_exposure_time = 300
+    reply, normal = server.admit_request(request())
+    assert reply == ""
+
+
+def test_handle_message_queues_request(tmp_path):
+    server = make_server(tmp_path)
+    reply = server.handle_message(encode(request(exposure_time="60")))
+    assert reply.split(" ")[0] == "1"
+    with open(server.filename) as queue:
+        saved = json.loads(queue.readline())
+    assert saved["exposure_time"] == 60.0
+    assert saved["filters"] == ["clear"]
+
+
+def test_handle_message_rejects_oversize_messages(tmp_path):
+    server = make_server(tmp_path)
+    reply = server.handle_message(encode(request(targets=["x"*20000])))
+    assert reply.startswith("rejected message exceeds")
+
+
+def test_handle_message_sheds_load_across_users(tmp_path):
+    server = make_server(tmp_path)
+    replies = [server.handle_message(encode(request(user="u{}".format(n))))
+               for n in range(30)]
+    # every user is new, so only the server-wide bucket stops the flood
+    assert all(r.split(" ")[0] == "1" for r in replies[:20])
+    assert all(r.startswith("retry") for r in replies[20:])
+    assert server.queue_length == 20
+
+
+def test_handle_message_rate_limits_each_user(tmp_path):
+    server = make_server(tmp_path)
+    replies = [server.handle_message(encode(request())) for n in range(12)]
+    assert replies[10].startswith("retry")
+    assert "rate limit" in replies[10]
+
+
+def test_handle_message_abusive_user_does_not_lock_out_others(tmp_path):
+    server = make_server(tmp_path)
+    for n in range(100):
+        mallory = server.handle_message(encode(request(user="mallory")))
+        if n % 10 == 0:
+            bob = server.handle_message(encode(request(user="bob")))
+            assert bob.split(" ")[0] == "1"
+    assert "rate limit" in mallory
+    assert server.queue_length == 20
+
+
+@pytest.mark.parametrize("fields", [{}, {"type": "state"},
+                                    {"type": "state", "action": "reboot"},
+                                    {"type": "shutdown"}])
+def test_handle_message_rejects_invalid_admin_messages(tmp_path, fields):
+    server = make_server(tmp_path)
+    message = dict({"magic": server.magic_admin, "user": "admin"}, **fields)
+    assert server.handle_message(encode(message)).startswith("rejected")
+    assert server.enabled
+
+
+def test_handle_message_disables_server(tmp_path):
+    server = make_server(tmp_path)
+    message = {"magic": server.magic_admin, "user": "admin",
+               "type": "state", "action": "disable"}
+    assert server.handle_message(encode(message)) == str(server.magic_admin)
+    assert server.handle_message(encode(request())).startswith("retry")
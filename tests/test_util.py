@@ -0,0 +1,57 @@
+import calendar
+import datetime
+import Util
+
+
+def test_night_date_runs_noon_to_noon():
+    # Sonoma is about 8h10m behind UTC in mean solar time
+    evening = calendar.timegm((2026, 10, 20, 4, 0, 0))
+    morning = calendar.timegm((2026, 10, 20, 18, 0, 0))
+    afternoon = calendar.timegm((2026, 10, 20, 21, 0, 0))
+    assert Util.night_date(evening, -122.50) == datetime.date(2026, 10, 19)
+    assert Util.night_date(morning, -122.50) == datetime.date(2026, 10, 19)
+    assert Util.night_date(afternoon, -122.50) == datetime.date(2026, 10, 20)
+
+
+def test_twilight_at_sonoma():
+    evening, morning = Util.twilight(datetime.date(2026, 10, 19), 38.29, -122.50)
+
+    # nautical twilight is about 02:24 and 13:26 UTC
+    assert abs(evening - calendar.timegm((2026, 10, 20, 2, 24, 0))) < 300
+    assert abs(morning - calendar.timegm((2026, 10, 20, 13, 26, 0))) < 300
+    assert Util.night_date(evening, -122.50) == Util.night_date(morning, -122.50)
+
+    # the sun sets before nautical twilight and rises after it
+    sunset, sunrise = Util.twilight(datetime.date(2026, 10, 19), 38.29, -122.50, -0.833)
+    assert sunset < evening and morning < sunrise
+
+
+def test_twilight_during_polar_summer():
+    assert Util.twilight(datetime.date(2026, 6, 21), 70.0, 20.0) is None
+
+
+def test_token_bucket_refills_at_rate(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(Util.time, "monotonic", lambda: now[0])
+    bucket = Util.TokenBucket(rate=0.5, capacity=2)
+
+    # the bucket starts full, then refuses until a token has refilled
+    assert bucket.consume() and bucket.consume()
+    assert not bucket.consume()
+    assert bucket.wait_time() == 2.0
+
+    now[0] += 1.0
+    assert bucket.wait_time() == 1.0
+    now[0] += 1.0
+    assert bucket.consume()
+
+    # tokens never accumulate past capacity
+    now[0] += 3600.0
+    assert bucket.refill() == 2
+
+
+def test_token_bucket_without_rate_never_refills():
+    bucket = Util.TokenBucket(rate=0, capacity=1)
+    assert bucket.consume()
+    assert not bucket.consume()
+    assert bucket.wait_time() == float("inf")